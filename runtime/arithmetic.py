@@ -0,0 +1,129 @@
+from objects import Compound, Integer, SmallInteger, Variable, atom
+from objects import wrap_int, wrap_bigint
+from rpython.rlib.rarithmetic import ovfcheck
+
+ADD = atom("+", 2)
+SUB = atom("-", 2)
+MUL = atom("*", 2)
+NEG = atom("-", 1)
+ABS = atom("abs", 1)
+DIV = atom("div", 2)
+MOD = atom("mod", 2)
+MIN = atom("min", 2)
+MAX = atom("max", 2)
+
+# Raised when an expression still contains a variable.
+# The caller decides whether to suspend on it or to fail.
+class Unbound(Exception):
+    def __init__(self, var):
+        self.var = var
+
+# Raised when an expression has no value, as foo + 1 or div(7, 0).
+# The builtins fail then, as there is nothing to wait for.
+class Undefined(Exception):
+    pass
+
+def evaluate(term):
+    term = term.unroll()
+    if isinstance(term, Integer):
+        return term
+    if isinstance(term, Variable):
+        raise Unbound(term)
+    if not isinstance(term, Compound):
+        raise Undefined()
+    fsym = term.fsym
+    if fsym is NEG:
+        return int_neg(evaluate(term.args[0]))
+    elif fsym is ABS:
+        x = evaluate(term.args[0])
+        if int_compare(x, wrap_int(0)) < 0:
+            return int_neg(x)
+        return x
+    elif fsym is ADD:
+        return int_add(evaluate(term.args[0]), evaluate(term.args[1]))
+    elif fsym is SUB:
+        return int_sub(evaluate(term.args[0]), evaluate(term.args[1]))
+    elif fsym is MUL:
+        return int_mul(evaluate(term.args[0]), evaluate(term.args[1]))
+    elif fsym is DIV:
+        return int_div(evaluate(term.args[0]), evaluate(term.args[1]))
+    elif fsym is MOD:
+        return int_mod(evaluate(term.args[0]), evaluate(term.args[1]))
+    elif fsym is MIN:
+        x = evaluate(term.args[0])
+        y = evaluate(term.args[1])
+        return x if int_compare(x, y) <= 0 else y
+    elif fsym is MAX:
+        x = evaluate(term.args[0])
+        y = evaluate(term.args[1])
+        return x if int_compare(x, y) >= 0 else y
+    raise Undefined()
+
+# Each operation stays on machine words and falls back
+# to rbigint only when the result would overflow.
+def int_add(x, y):
+    if isinstance(x, SmallInteger) and isinstance(y, SmallInteger):
+        try:
+            return wrap_int(ovfcheck(x.value + y.value))
+        except OverflowError as _:
+            pass
+    return wrap_bigint(x.tobigint().add(y.tobigint()))
+
+def int_sub(x, y):
+    if isinstance(x, SmallInteger) and isinstance(y, SmallInteger):
+        try:
+            return wrap_int(ovfcheck(x.value - y.value))
+        except OverflowError as _:
+            pass
+    return wrap_bigint(x.tobigint().sub(y.tobigint()))
+
+def int_mul(x, y):
+    if isinstance(x, SmallInteger) and isinstance(y, SmallInteger):
+        try:
+            return wrap_int(ovfcheck(x.value * y.value))
+        except OverflowError as _:
+            pass
+    return wrap_bigint(x.tobigint().mul(y.tobigint()))
+
+def int_neg(x):
+    return int_sub(wrap_int(0), x)
+
+# Division rounds towards negative infinity, and mod takes
+# the sign of the divisor.
+def int_div(x, y):
+    if int_is_zero(y):
+        raise Undefined()
+    if isinstance(x, SmallInteger) and isinstance(y, SmallInteger):
+        try:
+            return wrap_int(ovfcheck(x.value // y.value))
+        except OverflowError as _:
+            pass
+    return wrap_bigint(x.tobigint().floordiv(y.tobigint()))
+
+def int_mod(x, y):
+    if int_is_zero(y):
+        raise Undefined()
+    if isinstance(x, SmallInteger) and isinstance(y, SmallInteger):
+        try:
+            return wrap_int(ovfcheck(x.value % y.value))
+        except OverflowError as _:
+            pass
+    return wrap_bigint(x.tobigint().mod(y.tobigint()))
+
+def int_is_zero(x):
+    return isinstance(x, SmallInteger) and x.value == 0
+
+def int_compare(x, y):
+    if isinstance(x, SmallInteger) and isinstance(y, SmallInteger):
+        if x.value < y.value:
+            return -1
+        elif x.value > y.value:
+            return 1
+        return 0
+    a = x.tobigint()
+    b = y.tobigint()
+    if a.lt(b):
+        return -1
+    elif a.gt(b):
+        return 1
+    return 0
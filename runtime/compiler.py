@@ -0,0 +1,286 @@
+from objects import Compound, Integer, SmallInteger, Variable, AND, TRUE
+from objects import atom
+
+# Every clause is compiled into a flat sequence of integer instructions.
+# The head part reads the goal arguments in pre-order, the body part
+# builds the subgoals in post-order and hands them out with CALL.
+GET_VOID   = 0  #
+GET_VAR    = 1  # reg
+GET_VAL    = 2  # reg
+GET_CONST  = 3  # const
+GET_STRUCT = 4  # functor, end of the subterm
+PUT_VOID   = 5  #
+PUT_VAR    = 6  # reg
+PUT_VAL    = 7  # reg
+PUT_CONST  = 8  # const
+PUT_STRUCT = 9  # functor
+CALL       = 10 #
+PROCEED    = 11 #
+
+# A commit in the body of a clause is not compiled as a goal. The
+# clause records how many of the body goals come before it, or -1.
+COMMIT = atom("commit", 0)
+
+class ClauseCode:
+    _immutable_fields_ = ['ops[*]', 'consts[*]', 'functors[*]',
+                          'nregs', 'body_start', 'commit']
+    def __init__(self, ops, consts, functors, nregs, body_start, commit=-1):
+        self.ops = ops
+        self.consts = consts
+        self.functors = functors
+        self.nregs = nregs
+        self.body_start = body_start
+        self.commit = commit
+
+class Compiler:
+    def __init__(self, counts):
+        self.ops = []
+        self.consts = []
+        self.functors = []
+        self.counts = counts
+        self.regs = {}
+
+    def const(self, term):
+        for i in range(len(self.consts)):
+            if self.consts[i] is term:
+                return i
+        self.consts.append(term)
+        return len(self.consts) - 1
+
+    def functor(self, fsym):
+        for i in range(len(self.functors)):
+            if self.functors[i] is fsym:
+                return i
+        self.functors.append(fsym)
+        return len(self.functors) - 1
+
+    def var(self, var, void, first, later):
+        if self.counts[var] == 1:
+            self.ops.append(void)
+        elif var in self.regs:
+            self.ops.append(later)
+            self.ops.append(self.regs[var])
+        else:
+            reg = len(self.regs)
+            self.regs[var] = reg
+            self.ops.append(first)
+            self.ops.append(reg)
+
+    def get(self, term):
+        if isinstance(term, Variable):
+            self.var(term, GET_VOID, GET_VAR, GET_VAL)
+        elif is_ground(term):
+            self.ops.append(GET_CONST)
+            self.ops.append(self.const(term))
+        else:
+            assert isinstance(term, Compound)
+            self.ops.append(GET_STRUCT)
+            self.ops.append(self.functor(term.fsym))
+            self.ops.append(0)
+            patch = len(self.ops) - 1
+            for arg in term.args:
+                self.get(arg)
+            self.ops[patch] = len(self.ops)
+
+    def put(self, term):
+        if isinstance(term, Variable):
+            self.var(term, PUT_VOID, PUT_VAR, PUT_VAL)
+        elif is_ground(term):
+            self.ops.append(PUT_CONST)
+            self.ops.append(self.const(term))
+        else:
+            assert isinstance(term, Compound)
+            for arg in term.args:
+                self.put(arg)
+            self.ops.append(PUT_STRUCT)
+            self.ops.append(self.functor(term.fsym))
+
+def compile_clause(head, body):
+    assert isinstance(head, Compound)
+    counts = {}
+    count_vars(head, counts)
+    count_vars(body, counts)
+    comp = Compiler(counts)
+    for arg in head.args:
+        comp.get(arg)
+    body_start = len(comp.ops)
+    commit = -1
+    count = 0
+    for goal in conjuncts(body):
+        if commit < 0 and isinstance(goal, Compound) and goal.fsym is COMMIT:
+            commit = count
+            continue
+        comp.put(goal)
+        comp.ops.append(CALL)
+        count += 1
+    comp.ops.append(PROCEED)
+    return ClauseCode(comp.ops[:], comp.consts[:], comp.functors[:],
+        len(comp.regs), body_start, commit)
+
+def count_vars(term, counts):
+    term = term.unroll()
+    if isinstance(term, Variable):
+        counts[term] = counts.get(term, 0) + 1
+    elif isinstance(term, Compound):
+        for arg in term.args:
+            count_vars(arg, counts)
+
+def conjuncts(body):
+    goals = []
+    while isinstance(body, Compound) and body.fsym is AND:
+        goals.extend(conjuncts(body.args[0]))
+        body = body.args[1]
+    if not (isinstance(body, Compound) and body.fsym is TRUE):
+        goals.append(body)
+    return goals
+
+# Ground subterms are compiled as constants. Every instance of the
+# clause shares them, so a fact over constant data is entered without
+# building any of it.
+def is_ground(term):
+    term = term.unroll()
+    if isinstance(term, Compound):
+        for arg in term.args:
+            if not is_ground(arg):
+                return False
+        return True
+    return isinstance(term, Integer)
+
+# A CHR rule is compiled once for every head, the occurrence that an
+# active constraint is matched against. The active head comes first,
+# the partner heads follow in join order. The head segments hold GET
+# instructions, which the matcher reads as one-way matching. Each head
+# may be followed by a guard segment with the guard goals that can be
+# checked at that point, and the body segment comes last.
+class OccurrenceCode(ClauseCode):
+    _immutable_fields_ = ['order[*]', 'heads[*]', 'ends[*]', 'guards[*]',
+                          'lookups[*]', 'key_regs[*]', 'key_consts[*]']
+    def __init__(self, ops, consts, functors, nregs, body_start,
+            order, heads, ends, guards, lookups, key_regs, key_consts):
+        ClauseCode.__init__(self, ops, consts, functors, nregs, body_start)
+        self.order = order
+        self.heads = heads
+        self.ends = ends
+        self.guards = guards
+        self.lookups = lookups
+        self.key_regs = key_regs
+        self.key_consts = key_consts
+
+def compile_occurrence(pattern, guard, body, pivot):
+    counts = {}
+    for head in pattern:
+        count_vars(head, counts)
+    count_vars(guard, counts)
+    count_vars(body, counts)
+    order = join_order(pattern, pivot)
+
+    # A guard goal over head variables only is checked as soon as
+    # the last of its variables has been matched.
+    bound = {}
+    steps = []
+    for head in order:
+        count_vars(pattern[head], bound)
+        steps.append(bound.copy())
+    checks = [[] for _ in order]
+    for goal in conjuncts(guard):
+        vars = {}
+        count_vars(goal, vars)
+        step = len(order) - 1
+        for i in range(len(order)):
+            if all_in(vars, steps[i]):
+                step = i
+                break
+        checks[step].append(goal)
+
+    comp = Compiler(counts)
+    heads = []
+    ends = []
+    guards = []
+    lookups = []
+    key_regs = []
+    key_consts = []
+    for step in range(len(order)):
+        head = pattern[order[step]]
+        assert isinstance(head, Compound)
+        argno = -1
+        if step > 0:
+            argno = lookup_arg(head, steps[step-1])
+        lookups.append(argno)
+        if argno < 0:
+            key_regs.append(-1)
+            key_consts.append(-1)
+        elif isinstance(head.args[argno], Variable):
+            key_regs.append(comp.regs[head.args[argno]])
+            key_consts.append(-1)
+        else:
+            key_regs.append(-1)
+            key_consts.append(comp.const(head.args[argno]))
+        heads.append(len(comp.ops))
+        for arg in head.args:
+            comp.get(arg)
+        ends.append(len(comp.ops))
+        if len(checks[step]) > 0:
+            guards.append(len(comp.ops))
+            for goal in checks[step]:
+                comp.put(goal)
+                comp.ops.append(CALL)
+            comp.ops.append(PROCEED)
+        else:
+            guards.append(-1)
+    body_start = len(comp.ops)
+    for goal in conjuncts(body):
+        comp.put(goal)
+        comp.ops.append(CALL)
+    comp.ops.append(PROCEED)
+    return OccurrenceCode(comp.ops[:], comp.consts[:], comp.functors[:],
+        len(comp.regs), body_start, order[:], heads[:], ends[:], guards[:],
+        lookups[:], key_regs[:], key_consts[:])
+
+# The partner that shares the most with the heads matched so far
+# goes next: a variable that is already bound, then a functor or an
+# integer to look it up by. Ties keep the order of the rule.
+def join_order(pattern, pivot):
+    order = [pivot]
+    bound = {}
+    count_vars(pattern[pivot], bound)
+    while len(order) < len(pattern):
+        best = -1
+        best_score = -1
+        for i in range(len(pattern)):
+            if i in order:
+                continue
+            score = lookup_score(pattern[i], bound)
+            if score > best_score:
+                best = i
+                best_score = score
+        order.append(best)
+        count_vars(pattern[best], bound)
+    return order
+
+def lookup_score(head, bound):
+    argno = lookup_arg(head, bound)
+    if argno < 0:
+        return 0
+    assert isinstance(head, Compound)
+    if isinstance(head.args[argno], Variable):
+        return 2
+    return 1
+
+# The argument a head is looked up by in the constraint store, or -1.
+def lookup_arg(head, bound):
+    assert isinstance(head, Compound)
+    best = -1
+    for argno in range(len(head.args)):
+        arg = head.args[argno]
+        if isinstance(arg, Variable) and arg in bound:
+            return argno
+        elif best < 0 and not isinstance(arg, Variable):
+            if isinstance(arg, Compound) or isinstance(arg, SmallInteger):
+                best = argno
+    return best
+
+def all_in(vars, bound):
+    for var in vars:
+        if var not in bound:
+            return False
+    return True
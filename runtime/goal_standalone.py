@@ -23,10 +23,11 @@ def force_config(config):
 
 # Just-in-time compiler also needs to be configured,
 # although the runtime uses it without any additional kinks for now.
-# JIT is not used right now.
-# def jitpolicy(driver):
-#     from rpython.jit.codewriter.policy import JitPolicy
-#     return JitPolicy()
+# The policy is only consulted when translating with --opt=jit,
+# which is what ./build build --jit does.
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
  
 # The runtime can also run interpreted, as if it was an
 # ordinary Python script.
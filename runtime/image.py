@@ -0,0 +1,221 @@
+from objects import Compound, SmallInteger, BigInteger, Variable
+from objects import wrap_int, wrap_bigint
+from rpython.rlib import rmmap
+from rpython.rlib.objectmodel import we_are_translated
+from rpython.rlib.rarithmetic import intmask
+from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rmd5 import RMD5
+import os
+
+# A program image holds the parsed program, so that a warm start
+# skips lexing and parsing. It is written next to the source and is
+# valid only for the source whose digest it carries:
+#
+#     magic, digest, next_varno
+#     atom table: count, then arity, length and name of every atom
+#     program term in pre-order, every subterm starting with a tag
+#
+# Numbers are 8 bytes, little-endian.
+MAGIC = "SUCHIMG\x01"
+
+TAG_COMPOUND = "c"  # atom index, then the arguments
+TAG_INTEGER  = "i"  # value
+TAG_BIGINT   = "b"  # length, decimal digits
+TAG_VARIABLE = "v"  # varno
+
+class ImageError(Exception):
+    pass
+
+def image_path(path):
+    return path + ".img"
+
+def digest(source):
+    return RMD5(source).digest()
+
+def write_image(path, source, code, next_varno):
+    atoms = []
+    atom_index = {}
+    term = []
+    stack = [code]
+    while len(stack) > 0:
+        t = stack.pop().unroll()
+        if isinstance(t, Compound):
+            try:
+                index = atom_index[t.fsym]
+            except KeyError as _:
+                index = len(atoms)
+                atom_index[t.fsym] = index
+                atoms.append(t.fsym)
+            term.append(TAG_COMPOUND)
+            put_int(term, index)
+            i = len(t.args) - 1
+            while i >= 0:
+                stack.append(t.args[i])
+                i -= 1
+        elif isinstance(t, SmallInteger):
+            term.append(TAG_INTEGER)
+            put_int(term, t.value)
+        elif isinstance(t, BigInteger):
+            term.append(TAG_BIGINT)
+            put_string(term, t.stringify())
+        elif isinstance(t, Variable):
+            term.append(TAG_VARIABLE)
+            put_int(term, t.varno)
+        else:
+            raise ValueError("write_image: cannot store %s" % t.stringify())
+    out = [MAGIC, digest(source)]
+    put_int(out, next_varno)
+    put_int(out, len(atoms))
+    for fsym in atoms:
+        put_int(out, fsym.arity)
+        put_string(out, fsym.name)
+    out.append("".join(term))
+
+    # The image is written aside and renamed into place,
+    # so that a reader never sees half of it.
+    tmp = image_path(path) + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        data = "".join(out)
+        while len(data) > 0:
+            n = os.write(fd, data)
+            data = data[n:]
+    finally:
+        os.close(fd)
+    os.rename(tmp, image_path(path))
+
+def put_int(out, value):
+    for _ in range(8):
+        out.append(chr(value & 0xff))
+        value >>= 8
+
+def put_string(out, s):
+    put_int(out, len(s))
+    out.append(s)
+
+# Returns the program and next_varno from the image of the source,
+# with its atoms made in the given parser state. The program is None
+# when there is no image or it belongs to another source.
+def read_image(path, source, state):
+    try:
+        fd = os.open(image_path(path), os.O_RDONLY, 0)
+    except OSError as _:
+        return None, 0
+    try:
+        data = map_file(fd)
+    except rmmap.RMMapError as _:
+        return None, 0
+    except OSError as _:
+        return None, 0
+    finally:
+        os.close(fd)
+    try:
+        return decode(Reader(data), digest(source), state)
+    except ImageError as _:
+        return None, 0
+
+# Run untranslated, rmmap goes through ll2ctypes, and copying out of
+# the map takes longer than reading the file.
+def map_file(fd):
+    if not we_are_translated():
+        chunks = []
+        chunk = os.read(fd, 65536)
+        while len(chunk) > 0:
+            chunks.append(chunk)
+            chunk = os.read(fd, 65536)
+        return "".join(chunks)
+    m = rmmap.mmap(fd, 0, access=rmmap.ACCESS_READ)
+    try:
+        return m.getslice(0, m.size)
+    finally:
+        m.close()
+
+def decode(reader, expect, state):
+    if reader.take(len(MAGIC)) != MAGIC:
+        raise ImageError
+    if reader.take(len(expect)) != expect:
+        raise ImageError
+    next_varno = reader.int()
+    state.next_varno = next_varno
+    atoms = []
+    for _ in range(reader.int()):
+        arity = reader.int()
+        atoms.append(state.getatom(reader.string(), arity))
+
+    # The term is rebuilt the same way build_head does it, and the
+    # variables keep their identity through their numbers.
+    variables = {}
+    root = None
+    functors = []
+    argss = []
+    while root is None:
+        tag = reader.take(1)
+        if tag == TAG_COMPOUND:
+            index = reader.int()
+            if not 0 <= index < len(atoms):
+                raise ImageError
+            fsym = atoms[index]
+            if fsym.arity > 0:
+                functors.append(fsym)
+                argss.append([])
+                continue
+            term = Compound(fsym, [])
+        elif tag == TAG_INTEGER:
+            term = wrap_int(reader.int())
+        elif tag == TAG_BIGINT:
+            term = big_integer(reader.string())
+        elif tag == TAG_VARIABLE:
+            varno = reader.int()
+            try:
+                term = variables[varno]
+            except KeyError as _:
+                term = Variable(varno)
+                variables[varno] = term
+        else:
+            raise ImageError
+        while len(argss) > 0:
+            args = argss[-1]
+            args.append(term)
+            if len(args) < functors[-1].arity:
+                break
+            term = Compound(functors.pop(), argss.pop())
+        if len(argss) == 0:
+            root = term
+    if not reader.at_end():
+        raise ImageError
+    return root, next_varno
+
+def big_integer(digits):
+    try:
+        return wrap_bigint(rbigint.fromdecimalstr(digits))
+    except ValueError as _:
+        raise ImageError
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, n):
+        start = self.pos
+        stop = start + n
+        if n < 0 or stop > len(self.data):
+            raise ImageError
+        assert stop >= 0
+        self.pos = stop
+        return self.data[start:stop]
+
+    def int(self):
+        s = self.take(8)
+        value = 0
+        i = 7
+        while i >= 0:
+            value = (value << 8) | ord(s[i])
+            i -= 1
+        return intmask(value)
+
+    def string(self):
+        return self.take(self.int())
+
+    def at_end(self):
+        return self.pos == len(self.data)
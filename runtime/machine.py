@@ -1,33 +1,44 @@
-from objects import Atom, Compound, Integer, Variable
+from objects import Object, Atom, Compound, Integer, SmallInteger, Variable
 from objects import known_atoms, atom, as_list, wrap
-from objects import CONS, NIL, AND, OR, TRUE, FALSE, failure, success
-from objects import Trail, UNIFY_ATTS, BIND_HARD
-from objects import DepthFirstSearch, OrderedSearch
+from objects import CONS, NIL, AND, OR, TRUE, FALSE, DEF, LAST_DEF
+from objects import failure, success
+from objects import Trail, HistoryKey, UNIFY_ATTS, BIND_HARD, CHR_REVISE
+from objects import UNIFY, Barrier, Opaque, SCHEDULE_NONDET
+from objects import unify, OCCURS_CHECK_ALWAYS
+from objects import DepthFirstSearch, OrderedSearch, InlineGuard, wrap_int
+from objects import Search, SEARCH_ORDERED
+from arithmetic import evaluate, Unbound, Undefined, int_add, int_sub, int_compare
+from compiler import compile_clause, compile_occurrence
+from compiler import GET_VOID, GET_VAR, GET_VAL, GET_CONST, GET_STRUCT
+from compiler import PUT_VOID, PUT_VAR, PUT_VAL, PUT_CONST, PUT_STRUCT
+from compiler import CALL, PROCEED
+from rpython.rlib import jit
+from rpython.rlib.objectmodel import not_rpython
 import os
+import sys
 
 CLAUSE = atom("<-", 2)
 CONSTRAINT_RULE = atom("constraint_rule", 5)
-
-SAME = atom("same", 2)
-UNIFY = atom("=", 2)
-COND2 = atom("cond", 2)
-DEF = atom("DEF", 2)
+TABLE = atom("table", 1)
 
 def load(code, varno=100, debug=False):
-    defs = {}
+    clauses = {}
     chrs = []
     constraints = {}
+    indexed = {}
+    tabled = {}
     occurrenceno = 0
-    for clause in reversed(as_list(code)):
+    for clause in as_list(code):
         assert isinstance(clause, Compound)
         if clause.fsym is CLAUSE:
             head = clause.args[0]
             assert isinstance(head, Compound)
-            if head.fsym in defs:
-                rest = defs[head.fsym]
-            else:
-                rest = Compound(NIL, [])
-            defs[head.fsym] = Compound(CONS, [clause, rest])
+            try:
+                seq = clauses[head.fsym]
+            except KeyError as _:
+                seq = []
+                clauses[head.fsym] = seq
+            seq.append(Clause(head, clause.args[1]))
         elif clause.fsym is CONSTRAINT_RULE:
             name = clause.args[0]
             assert isinstance(name, Compound)
@@ -36,197 +47,1118 @@ def load(code, varno=100, debug=False):
             drop = as_list(clause.args[2])
             guard = clause.args[3]
             goal = clause.args[4]
-            this = CHR(name, keep + drop, len(keep), guard, goal)
+            this = CHR(len(chrs), name, keep + drop, len(keep), guard, goal)
             chrs.append(this)
-            index = 0
-            for k in this.pattern:
+            for code in this.occurrences:
+                for step in range(len(code.order)):
+                    k = this.pattern[code.order[step]]
+                    argno = code.lookups[step]
+                    assert isinstance(k, Compound)
+                    if argno < 0:
+                        continue
+                    argnos = indexed.setdefault(k.fsym, [])
+                    if argno not in argnos:
+                        argnos.append(argno)
+            # The rules are tried in the order they are written, and
+            # within a rule the removed heads before the kept ones.
+            index = len(this.pattern) - 1
+            while index >= 0:
+                k = this.pattern[index]
                 assert isinstance(k, Compound)
                 if k.fsym in constraints:
-                    constraints[k.fsym].insert(0, (this, index))
+                    constraints[k.fsym].append((this, index))
                 else:
                     constraints[k.fsym] = [(this, index)]
-                index += 1
+                index -= 1
+        elif clause.fsym is TABLE:
+            for decl in as_list(clause.args[0]):
+                assert isinstance(decl, Compound)
+                name = decl.args[0]
+                arity = decl.args[1]
+                assert isinstance(name, Compound)
+                assert isinstance(arity, SmallInteger)
+                tabled[(name.fsym.name, arity.value)] = None
         else:
             raise ValueError("machine.load received a non-program")
 
-    return Program(defs, constraints)
+    for fsym in constraints:
+        if fsym in builtins:
+            raise ValueError("%s/%d is a builtin and cannot be a constraint"
+                % (fsym.name, fsym.arity))
+    for fsym in clauses:
+        if fsym in builtins:
+            raise ValueError("%s/%d is a builtin and cannot be redefined"
+                % (fsym.name, fsym.arity))
+
+    # The atoms are shared between the programs that are loaded, so
+    # the handlers of the previous program are taken away first.
+    for fsym in installed:
+        fsym.handler = None
+    del installed[:]
+    for fsym, builtin in builtins.iteritems():
+        fsym.handler = builtin
+    for fsym in constraints:
+        fsym.handler = Constraint(fsym)
+        installed.append(fsym)
+    for fsym, seq in clauses.iteritems():
+        if (fsym.name, fsym.arity) in tabled:
+            fsym.handler = TabledPredicate(fsym, seq[:])
+        else:
+            fsym.handler = Predicate(fsym, seq[:])
+        installed.append(fsym)
+    return Program(constraints, indexed)
+
+# The atoms that the loaded program gave a handler to.
+installed = []
+
+# Every atom carries a handler that solve() dispatches the goal to.
+# The handler returns True when it entered a clause of a user
+# predicate, which is where the JIT looks for loops.
+class Handler(object):
+    def call(self, mach, program, goal):
+        raise NotImplementedError("Handler.call")
+
+class Builtin(Handler):
+    _immutable_fields_ = ['name', 'fn', 'test']
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        self.test = None
+
+    def call(self, mach, program, goal):
+        self.fn(mach, program, goal)
+        return False
+
+class Constraint(Handler):
+    _immutable_fields_ = ['fsym']
+    def __init__(self, fsym):
+        self.fsym = fsym
+
+    def call(self, mach, program, goal):
+        chr_add_constraint(goal, mach, program)
+        return False
+
+class Clause:
+    _immutable_fields_ = ['head', 'body', 'code']
+    def __init__(self, head, body):
+        self.head = head
+        self.body = body
+        self.code = compile_clause(head, body)
+
+# Clauses of a predicate are indexed by the principal functor or
+# the integer value of an argument. The first argument is always
+# indexed, the remaining arguments when most of the clauses have a
+# key there.
+class Predicate(Handler):
+    _immutable_fields_ = ['fsym', 'clauses', 'indexes[*]']
+    def __init__(self, fsym, clauses):
+        self.fsym = fsym
+        self.clauses = clauses
+        self.indexes = build_indexes(fsym, clauses)
+
+    # Returns the clauses that may match the goal, in program order.
+    @jit.unroll_safe
+    def candidates(self, goal):
+        best = self.clauses
+        for index in self.indexes:
+            clauses = index.lookup(goal.args[index.argno])
+            if clauses is not None and len(clauses) < len(best):
+                best = clauses
+        return best
+
+    def call(self, mach, program, goal):
+        clauses = self.candidates(goal)
+        if len(clauses) == 0:
+            mach.state.fail()
+        elif len(clauses) == 1:
+            invoke_clause(mach, goal, clauses[0], mach.state.height())
+            return True
+        else:
+            mach.state.invoke(Compound(DEF, [goal, wrap(0)]))
+        return False
+
+def build_indexes(fsym, clauses):
+    indexes = []
+    for argno in range(fsym.arity):
+        index = ClauseIndex(argno)
+        for clause in clauses:
+            index.add(clause)
+        if argno == 0 and index.keyed > 0:
+            indexes.append(index)
+        elif index.keyed > 0 and len(index.unkeyed) * 2 < len(clauses):
+            indexes.append(index)
+    return indexes[:]
+
+class ClauseIndex:
+    _immutable_fields_ = ['argno']
+    def __init__(self, argno):
+        self.argno = argno
+        self.functors = {}
+        self.integers = {}
+        self.unkeyed = []
+        self.keyed = 0
+
+    def distinct(self):
+        return len(self.functors) + len(self.integers)
+
+    def add(self, clause):
+        arg = clause.head.args[self.argno].unroll()
+        if isinstance(arg, Compound):
+            try:
+                bucket = self.functors[arg.fsym]
+            except KeyError as _:
+                bucket = list(self.unkeyed)
+                self.functors[arg.fsym] = bucket
+        elif isinstance(arg, SmallInteger):
+            n = arg.value
+            try:
+                bucket = self.integers[n]
+            except KeyError as _:
+                bucket = list(self.unkeyed)
+                self.integers[n] = bucket
+        else:
+            # A variable, or an integer too large to key with,
+            # may match anything and goes into every bucket.
+            self.unkeyed.append(clause)
+            for bucket in self.functors.itervalues():
+                bucket.append(clause)
+            for bucket in self.integers.itervalues():
+                bucket.append(clause)
+            return
+        bucket.append(clause)
+        self.keyed += 1
+
+    # None means the argument cannot be used for selecting clauses.
+    def lookup(self, arg):
+        arg = arg.unroll()
+        if isinstance(arg, Compound):
+            return self.functors.get(arg.fsym, self.unkeyed)
+        elif isinstance(arg, SmallInteger):
+            return self.integers.get(arg.value, self.unkeyed)
+        return None
 
 class Program:
-    def __init__(self, defs, constraints):
-        self.defs = defs
+    _immutable_fields_ = ['constraints', 'indexed']
+    def __init__(self, constraints, indexed):
         self.constraints = constraints
+        self.indexed = indexed
+        self.occurs_check = OCCURS_CHECK_ALWAYS
+        self.search = Search(SEARCH_ORDERED)
+        self.evaluating = []
+        self.incomplete = []
+        self.answer_count = 0
 
-    def solve(self, cb, goal, next_varno):
-        state = OrderedSearch(goal, [], cb)
-        mach = Trail(state, next_varno)
+    # A query runs in the search given for it, or else in the one
+    # set for the program.
+    def solve(self, cb, goal, next_varno, search=None):
+        if search is None:
+            search = self.search
+        mach = self.new_machine(search.start(goal, cb), next_varno)
         return solve(mach, self)
 
+    # The solutions of the goal, each computed when it is asked for.
+    def solutions(self, goal, next_varno, limit=-1, search=None):
+        if search is None:
+            search = self.search
+        mach = self.new_machine(OrderedSearch(success, [], Success()),
+            next_varno)
+        return Solutions(mach, self, goal, limit, search)
+
+    def new_machine(self, state, next_varno):
+        mach = Trail(state, next_varno)
+        mach.occurs_check = self.occurs_check
+        mach.chr_indexed = self.indexed
+        return mach
+
 WRITE = atom("write", 1)
+ANSWER = atom("ANSWER", 3, SCHEDULE_NONDET)
 EXIT = atom("exit", 1)
 
-CHR_RESUME   = atom("chr_resume", 2)
-CHR_PRINTOUT = atom("chr_printout", 0)
-CHR_REVISE   = atom("chr_revise", 1)
+CHR_RESUME   = atom("chr_resume", 3)
+
+def get_printable_location(fsym):
+    return "%s/%d" % (fsym.name, fsym.arity)
+
+# The dispatch loop is traced from one call of a user predicate to
+# the next one of the same predicate, so the green is the predicate
+# that is about to be dispatched. Clause code is promoted inside
+# invoke_clause, which makes the instruction loops unroll in traces.
+jitdriver = jit.JitDriver(
+    greens=['fsym'],
+    reds=['goal', 'mach', 'program'],
+    get_printable_location=get_printable_location,
+    is_recursive=True)
 
-GET_ATTS = atom("get_atts", 2)
-PUT_ATTS = atom("put_atts", 2)
-LIST_ATTS = atom("list_atts", 2)
+# Set to print every dispatched goal.
+DEBUG = False
 
-def solve(mach, program, debug=False):
+def solve(mach, program):
     goal = mach.state.next_goal(mach)
     while goal is not None:
-        if debug:
+        fsym = goal.fsym
+        jitdriver.jit_merge_point(fsym=fsym,
+            goal=goal, mach=mach, program=program)
+        if DEBUG:
             print
-            for _, a in mach.state.disj:
-                print "   " + a.stringify()
-            print "** " + goal.stringify() + "#" + mach.state.conj.stringify()
-        if goal.fsym is TRUE:
-            pass
-        elif goal.fsym is FALSE:
+            print "** %s # %s (%d choicepoints)" % (goal.stringify(),
+                mach.state.describe(), mach.state.height())
+        mach.step_varno = mach.next_varno
+        mach.step_shared = False
+        handler = fsym.handler
+        if handler is None:
+            raise ValueError("unknown predicate: %s" % goal.stringify())
+        call = handler.call(mach, program, goal)
+        if DEBUG:
+            print "=> " + mach.state.describe()
+        goal = mach.state.next_goal(mach)
+        if call and goal is not None:
+            fsym = goal.fsym
+            jitdriver.can_enter_jit(fsym=fsym,
+                goal=goal, mach=mach, program=program)
+
+# The builtin registry. load() installs these handlers into the atoms,
+# and a program may not define a predicate or a constraint of its own
+# under the name of a builtin:
+#
+#     @builtin("nl", 0)
+#     def builtin_nl(mach, program, goal):
+#         os.write(1, "\n")
+#
+# The function fails the goal through mach.state.fail().
+builtins = {}
+
+@not_rpython
+def builtin(name, arity):
+    fsym = atom(name, arity)
+    def _decorator_(fn):
+        builtins[fsym] = Builtin("%s/%d" % (name, arity), fn)
+        return fn
+    return _decorator_
+
+# A builtin that only tests its arguments may also register a test,
+# which guards run inline instead of going through a nested solve.
+# The test returns GUARD_UNKNOWN when it would have to wait for a
+# variable, and then the guard is solved in full.
+#
+#     @guard_test("same", 2)
+#     def test_same(mach, goal):
+#         return guard_result(goal.args[0].same(goal.args[1]))
+GUARD_FAIL    = 0
+GUARD_PASS    = 1
+GUARD_UNKNOWN = 2
+
+@not_rpython
+def guard_test(name, arity):
+    fsym = atom(name, arity)
+    def _decorator_(test):
+        builtins[fsym].test = test
+        return test
+    return _decorator_
+
+def guard_result(passed):
+    if passed:
+        return GUARD_PASS
+    return GUARD_FAIL
+
+@builtin("true", 0)
+def builtin_true(mach, program, goal):
+    pass
+
+@guard_test("true", 0)
+def test_true(mach, goal):
+    return GUARD_PASS
+
+@builtin("false", 0)
+def builtin_false(mach, program, goal):
+    mach.state.fail()
+
+@guard_test("false", 0)
+def test_false(mach, goal):
+    return GUARD_FAIL
+
+@builtin("and", 2)
+def builtin_and(mach, program, goal):
+    car = goal.args[0]
+    cdr = goal.args[1]
+    mach.state.expand([car, cdr])
+
+@builtin("or", 2)
+def builtin_or(mach, program, goal):
+    car = goal.args[0]
+    cdr = goal.args[1]
+    mach.state.choicepoint(mach, [cdr])
+    mach.state.invoke(car)
+
+@builtin("same", 2)
+def builtin_same(mach, program, goal):
+    car = goal.args[0]
+    cdr = goal.args[1]
+    if not car.same(cdr):
+        mach.state.fail()
+
+@guard_test("same", 2)
+def test_same(mach, goal):
+    return guard_result(goal.args[0].same(goal.args[1]))
+
+@builtin("=", 2)
+def builtin_unify(mach, program, goal):
+    left = goal.args[0]
+    right = goal.args[1]
+    if not mach.unify(left, right):
+        mach.state.fail()
+
+@guard_test("=", 2)
+def test_unify(mach, goal):
+    return guard_result(mach.unify(goal.args[0], goal.args[1]))
+
+@builtin("unify_with_occurs_check", 2)
+def builtin_unify_with_occurs_check(mach, program, goal):
+    left = goal.args[0]
+    right = goal.args[1]
+    mode = mach.occurs_check
+    mach.occurs_check = OCCURS_CHECK_ALWAYS
+    ok = mach.unify(left, right)
+    mach.occurs_check = mode
+    if not ok:
+        mach.state.fail()
+
+# Arithmetic waits for its operands the same way write/1 does:
+# the goal is frozen on the variables that are still unbound and
+# runs again once one of them is bound. Inside a guard it fails,
+# as waiting would let the guard pass before the test is made. That
+# is a rule guard, the condition of cond/2 and the goal that once/1,
+# if/3 or a commit in a clause body has not committed to yet.
+#
+# A frozen goal is tagged with the count of goals frozen before it,
+# and keeps the tag when it wakes up and has to wait again. A goal
+# that was waiting before the guard started is no part of it, and
+# goes back to waiting.
+RESUME = atom("RESUME", 2)
+
+def suspend(mach, vars, goal):
+    tag = mach.resume_tag
+    if tag < 0:
+        tag = mach.freeze_count
+        mach.freeze_count += 1
+    if mach.chr_lock or within_guard(tag, mach.cond_mark) or (
+            within_guard(tag, mach.state.guard_mark())):
+        mach.state.fail()
+    else:
+        resume = Compound(RESUME, [goal, wrap(tag)])
+        for var in vars:
+            mach.freeze(var, resume)
+
+def within_guard(tag, mark):
+    return mark >= 0 and tag >= mark
+
+@builtin("RESUME", 2)
+def builtin_resume(mach, program, goal):
+    inner = goal.args[0]
+    assert isinstance(inner, Compound)
+    tag = goal.args[1]
+    assert isinstance(tag, SmallInteger)
+    mach.resume_tag = tag.value
+    inner.fsym.handler.call(mach, program, inner)
+    mach.resume_tag = -1
+
+@builtin("is", 2)
+def builtin_is(mach, program, goal):
+    try:
+        value = evaluate(goal.args[1])
+    except Unbound as e:
+        suspend(mach, [e.var], goal)
+    except Undefined as _:
+        mach.state.fail()
+    else:
+        if not mach.unify(goal.args[0], value):
             mach.state.fail()
-        elif goal.fsym is AND:
-            car = goal.args[0]
-            cdr = goal.args[1]
-            mach.state.expand([car, cdr])
-        elif goal.fsym is OR:
-            car = goal.args[0]
-            cdr = goal.args[1]
-            mach.state.choicepoint(mach, [cdr])
-            mach.state.invoke(car)
-        elif goal.fsym is SAME:
-            car = goal.args[0]
-            cdr = goal.args[1]
-            if not car.same(cdr):
-                mach.state.fail()
-        elif goal.fsym is UNIFY:
-            left = goal.args[0]
-            right = goal.args[1]
-            if not mach.unify(left, right):
-                mach.state.fail()
-        # I wonder if this is still required, or if it should be improved.
-        elif goal.fsym is COND2:
-            mach.backtrack += 1
-            t = mach.note()
-            csucc = CondSuccess()
-            cgoal = goal.args[0]
-            cconj = goal.args[1]
-            this_state = mach.state
-            mach.state = mach.state.subgoal(cgoal, [], csucc)
-            solve(mach, program, debug)
-            mach.state = this_state
-            mach.backtrack -= 1
-            if csucc.success:
-                mach.state.invoke(cconj)
-            else:
-                mach.undo(t)
-        elif goal.fsym is GET_ATTS:
-            var = goal.args[0]
-            spec = goal.args[1]
-            assert isinstance(spec, Compound)
-            val = var.attr.get(spec.fsym, None)
-            if val is None:
-                mach.state.fail()
-            else:
-                if not mach.unify(val, spec):
-                    mach.state.fail()
-        elif goal.fsym is PUT_ATTS:
-            var = goal.args[0]
-            spec = goal.args[1]
-            assert isinstance(spec, Compound)
-            mach.put_atts(var, spec.fsym, spec)
-        elif goal.fsym is BIND_HARD:
-            var = goal.args[0]
-            val = goal.args[1]
-            if isinstance(var, Variable) and var.instance is var:
-                mach.bind_hard(var, val)
-            else:
-                if not mach.unify(var, val):
-                    mach.state.fail()
-        elif goal.fsym is LIST_ATTS:
-            var = goal.args[0]
-            assert isinstance(var, Variable)
-            ret = goal.args[1]
-            res = Compound(NIL, [])
-            for val in var.attr.itervalues():
-                res = Compound(CONS, [val, res])
-            if not mach.unify(ret, res):
-                mach.state.fail()
-        elif goal.fsym is DEF:
-            head = goal.args[0]
-            clause = goal.args[1]
-            assert clause.fsym is CONS
-            assert clause.args[0].fsym is CLAUSE
-            top = mach.variant(clause.args[0])
-            nxt = clause.args[1]
-            if nxt.fsym is not NIL:
-                mach.state.choicepoint(mach, [Compound(DEF, [head, nxt])])
-            mach.state.expand([Compound(UNIFY, [head, top.args[0]]),
-                #Compound(WRITE, [head]),
-                top.args[1]])
-        elif goal.fsym in program.defs:
-            clauses = program.defs[goal.fsym]
-            mach.state.invoke(Compound(DEF, [goal, clauses]))
-        elif goal.fsym in program.constraints:
-            chr_add_constraint(goal, mach, program)
-        elif goal.fsym is CHR_RESUME:
-            chrid = goal.args[0]
-            assert isinstance(chrid, Integer)
-            chrid = chrid.bignum.toint()
-            start = goal.args[1]
-            assert isinstance(start, Integer)
-            start = start.bignum.toint()
-            chr_resume(chrid, start, mach, program)
-        # Implementation of side effects in logic language
-        # are bit of a question.
-        # This looks like slightly wrong way to do it.
-        elif goal.fsym is EXIT:
-            a = goal.args[0].unroll()
-            if is_ground(a):
-                if isinstance(a, Integer):
-                    raise Exiting(a.bignum.toint())
-                else:
-                    mach.state.fail()
-            elif mach.chr_lock:
+
+@guard_test("is", 2)
+def test_is(mach, goal):
+    try:
+        value = evaluate(goal.args[1])
+    except Unbound as _:
+        return GUARD_UNKNOWN
+    except Undefined as _:
+        return GUARD_FAIL
+    return guard_result(mach.unify(goal.args[0], value))
+
+def compare_args(mach, goal):
+    try:
+        x = evaluate(goal.args[0])
+        y = evaluate(goal.args[1])
+    except Unbound as e:
+        suspend(mach, [e.var], goal)
+        return 0, False
+    except Undefined as _:
+        mach.state.fail()
+        return 0, False
+    return int_compare(x, y), True
+
+# An undefined operand is left to the nested solve, where the
+# builtin fails.
+def compare_test(goal):
+    try:
+        x = evaluate(goal.args[0])
+        y = evaluate(goal.args[1])
+    except Unbound as _:
+        return 0, False
+    except Undefined as _:
+        return 0, False
+    return int_compare(x, y), True
+
+@builtin("<", 2)
+def builtin_lt(mach, program, goal):
+    c, ok = compare_args(mach, goal)
+    if ok and not c < 0:
+        mach.state.fail()
+
+@guard_test("<", 2)
+def test_lt(mach, goal):
+    c, ok = compare_test(goal)
+    if not ok:
+        return GUARD_UNKNOWN
+    return guard_result(c < 0)
+
+@builtin("=<", 2)
+def builtin_le(mach, program, goal):
+    c, ok = compare_args(mach, goal)
+    if ok and not c <= 0:
+        mach.state.fail()
+
+@guard_test("=<", 2)
+def test_le(mach, goal):
+    c, ok = compare_test(goal)
+    if not ok:
+        return GUARD_UNKNOWN
+    return guard_result(c <= 0)
+
+@builtin(">", 2)
+def builtin_gt(mach, program, goal):
+    c, ok = compare_args(mach, goal)
+    if ok and not c > 0:
+        mach.state.fail()
+
+@guard_test(">", 2)
+def test_gt(mach, goal):
+    c, ok = compare_test(goal)
+    if not ok:
+        return GUARD_UNKNOWN
+    return guard_result(c > 0)
+
+@builtin(">=", 2)
+def builtin_ge(mach, program, goal):
+    c, ok = compare_args(mach, goal)
+    if ok and not c >= 0:
+        mach.state.fail()
+
+@guard_test(">=", 2)
+def test_ge(mach, goal):
+    c, ok = compare_test(goal)
+    if not ok:
+        return GUARD_UNKNOWN
+    return guard_result(c >= 0)
+
+@builtin("=:=", 2)
+def builtin_arith_eq(mach, program, goal):
+    c, ok = compare_args(mach, goal)
+    if ok and not c == 0:
+        mach.state.fail()
+
+@guard_test("=:=", 2)
+def test_arith_eq(mach, goal):
+    c, ok = compare_test(goal)
+    if not ok:
+        return GUARD_UNKNOWN
+    return guard_result(c == 0)
+
+@builtin("=\\=", 2)
+def builtin_arith_ne(mach, program, goal):
+    c, ok = compare_args(mach, goal)
+    if ok and not c != 0:
+        mach.state.fail()
+
+@guard_test("=\\=", 2)
+def test_arith_ne(mach, goal):
+    c, ok = compare_test(goal)
+    if not ok:
+        return GUARD_UNKNOWN
+    return guard_result(c != 0)
+
+# The type tests never wait for their argument, so each of them is
+# a builtin and a guard test at once.
+@not_rpython
+def type_test(name):
+    def _decorator_(test):
+        def fn(mach, program, goal):
+            if test(mach, goal) == GUARD_FAIL:
                 mach.state.fail()
+        builtin(name, 1)(fn)
+        guard_test(name, 1)(test)
+        return test
+    return _decorator_
+
+@type_test("var")
+def test_var(mach, goal):
+    return guard_result(isinstance(goal.args[0].unroll(), Variable))
+
+@type_test("nonvar")
+def test_nonvar(mach, goal):
+    return guard_result(not isinstance(goal.args[0].unroll(), Variable))
+
+@type_test("integer")
+def test_integer(mach, goal):
+    return guard_result(isinstance(goal.args[0].unroll(), Integer))
+
+@type_test("atom")
+def test_atom(mach, goal):
+    arg = goal.args[0].unroll()
+    return guard_result(isinstance(arg, Compound) and len(arg.args) == 0)
+
+@type_test("compound")
+def test_compound(mach, goal):
+    arg = goal.args[0].unroll()
+    return guard_result(isinstance(arg, Compound) and len(arg.args) > 0)
+
+@type_test("atomic")
+def test_atomic(mach, goal):
+    arg = goal.args[0].unroll()
+    if isinstance(arg, Compound):
+        return guard_result(len(arg.args) == 0)
+    return guard_result(isinstance(arg, Integer))
+
+# succ/2 and plus/3 run in whichever direction their bound
+# arguments allow, and otherwise wait for them.
+@builtin("succ", 2)
+def builtin_succ(mach, program, goal):
+    x = goal.args[0].unroll()
+    y = goal.args[1].unroll()
+    if isinstance(x, Integer):
+        if int_compare(x, wrap_int(0)) < 0:
+            mach.state.fail()
+        elif not mach.unify(y, int_add(x, wrap_int(1))):
+            mach.state.fail()
+    elif isinstance(y, Integer):
+        if int_compare(y, wrap_int(0)) <= 0:
+            mach.state.fail()
+        elif not mach.unify(x, int_sub(y, wrap_int(1))):
+            mach.state.fail()
+    elif isinstance(x, Variable) and isinstance(y, Variable):
+        suspend(mach, [x, y], goal)
+    else:
+        mach.state.fail()
+
+@builtin("plus", 3)
+def builtin_plus(mach, program, goal):
+    x = goal.args[0].unroll()
+    y = goal.args[1].unroll()
+    z = goal.args[2].unroll()
+    unbound = [a for a in [x, y, z] if isinstance(a, Variable)]
+    if len(unbound) > 1:
+        suspend(mach, unbound, goal)
+    elif isinstance(z, Variable):
+        plus_solve(mach, z, x, y, int_add)
+    elif isinstance(y, Variable):
+        plus_solve(mach, y, z, x, int_sub)
+    else:
+        plus_solve(mach, x, z, y, int_sub)
+
+def plus_solve(mach, out, x, y, op):
+    if not (isinstance(x, Integer) and isinstance(y, Integer)):
+        mach.state.fail()
+    elif not mach.unify(out, op(x, y)):
+        mach.state.fail()
+
+@builtin("cond", 2)
+def builtin_cond(mach, program, goal):
+    mach.backtrack += 1
+    t = mach.note()
+    cgoal = goal.args[0]
+    cconj = goal.args[1]
+    outer = mach.cond_mark
+    if outer < 0:
+        mach.cond_mark = mach.freeze_count
+    success = solve_guard(mach, program, [cgoal])
+    mach.cond_mark = outer
+    mach.backtrack -= 1
+    if success:
+        mach.state.invoke(cconj)
+    else:
+        mach.undo(t)
+    mach.trim()
+
+# The all-solutions builtins run their goal in a nested search and
+# leave no bindings of it behind. The results are copies.
+@builtin("findall", 3)
+def builtin_findall(mach, program, goal):
+    template = goal.args[0]
+    results = []
+    solutions = Solutions(mach, program, goal.args[1], -1)
+    while solutions.next():
+        results.append(mach.variant(template))
+    solutions.close()
+    if not mach.unify(goal.args[2], make_list(results)):
+        mach.state.fail()
+
+# bagof/3 fails when there are no solutions, and gives one bag for
+# every binding of the variables that occur in the goal only. The
+# bags come in the order their first solutions were found.
+@builtin("bagof", 3)
+def builtin_bagof(mach, program, goal):
+    template = goal.args[0]
+    witness = make_list(free_vars(goal.args[1], template))
+    pair = Compound(CONS, [witness, template])
+    witnesses = []
+    bags = []
+    solutions = Solutions(mach, program, goal.args[1], -1)
+    while solutions.next():
+        copy = mach.variant(pair)
+        assert isinstance(copy, Compound)
+        for i in range(len(witnesses) + 1):
+            if i == len(witnesses):
+                witnesses.append(copy.args[0])
+                bags.append([copy.args[1]])
+            elif is_variant(witnesses[i], copy.args[0]):
+                bags[i].append(copy.args[1])
+                break
+    solutions.close()
+    if len(bags) == 0:
+        mach.state.fail()
+        return
+    i = len(bags) - 1
+    alternatives = bag_goal(witness, witnesses[i], goal.args[2], bags[i])
+    while i > 0:
+        i -= 1
+        alternatives = Compound(OR, [
+            bag_goal(witness, witnesses[i], goal.args[2], bags[i]),
+            alternatives])
+    mach.state.invoke(alternatives)
+
+def bag_goal(witness, value, bag, results):
+    return Compound(AND, [
+        Compound(UNIFY, [witness, value]),
+        Compound(UNIFY, [bag, make_list(results)])])
+
+@builtin("forall", 2)
+def builtin_forall(mach, program, goal):
+    ok = True
+    solutions = Solutions(mach, program, goal.args[0], -1)
+    while ok and solutions.next():
+        action = Solutions(mach, program, goal.args[1], 1)
+        ok = action.next()
+        action.close()
+    solutions.close()
+    if not ok:
+        mach.state.fail()
+
+def conjunction(goals):
+    if len(goals) == 0:
+        return success
+    conj = goals[len(goals)-1]
+    for i in range(len(goals)-2, -1, -1):
+        conj = Compound(AND, [goals[i], conj])
+    return conj
+
+def make_list(items):
+    result = Compound(NIL, [])
+    i = len(items) - 1
+    while i >= 0:
+        result = Compound(CONS, [items[i], result])
+        i -= 1
+    return result
+
+# The unbound variables of the term that do not occur in 'exclude',
+# in the order they first appear.
+def free_vars(term, exclude):
+    seen = {}
+    for var in term_vars(exclude):
+        seen[var] = None
+    result = []
+    for var in term_vars(term):
+        if var not in seen:
+            seen[var] = None
+            result.append(var)
+    return result
+
+def term_vars(term):
+    result = []
+    seen = {}
+    stack = [term]
+    while len(stack) > 0:
+        t = stack.pop().unroll()
+        if isinstance(t, Variable):
+            if t not in seen:
+                seen[t] = None
+                result.append(t)
+        elif isinstance(t, Compound):
+            i = len(t.args) - 1
+            while i >= 0:
+                stack.append(t.args[i])
+                i -= 1
+    return result
+
+# Two terms are variants when they are equal up to
+# a consistent renaming of their variables.
+def is_variant(a, b):
+    left = {}
+    right = {}
+    stack = [a, b]
+    while len(stack) > 0:
+        y = stack.pop().unroll()
+        x = stack.pop().unroll()
+        if isinstance(x, Variable) and isinstance(y, Variable):
+            if left.get(x, y) is not y or right.get(y, x) is not x:
+                return False
+            left[x] = y
+            right[y] = x
+        elif isinstance(x, Compound) and isinstance(y, Compound):
+            if x.fsym is not y.fsym:
+                return False
+            for i in range(len(x.args)):
+                stack.append(x.args[i])
+                stack.append(y.args[i])
+        elif isinstance(x, Integer):
+            if not x.same(y):
+                return False
+        else:
+            return False
+    return True
+
+# once/1 and if/3 commit to the first solution of a goal. The goal
+# runs in the search in progress, and the commit takes away the
+# choicepoints it left behind.
+@builtin("once", 1)
+def builtin_once(mach, program, goal):
+    mach.state.once(goal.args[0].unroll(), success, mach.state.height(),
+        mach.freeze_count)
+
+@builtin("if", 3)
+def builtin_if(mach, program, goal):
+    height = mach.state.height()
+    mach.state.choicepoint(mach, [goal.args[2]])
+    mach.state.once(goal.args[0].unroll(), goal.args[1], height,
+        mach.freeze_count)
+
+@builtin("COMMIT", 1)
+def builtin_commit(mach, program, goal):
+    barrier = goal.args[0]
+    assert isinstance(barrier, Barrier)
+    mach.state.commit(mach, barrier)
+    mach.trim()
+
+# Adds to the cost of the branch, which best-first search
+# goes by. The other searches take no notice of it. A cost that
+# does not fit a machine word counts as the largest one that does.
+@builtin("cost", 1)
+def builtin_cost(mach, program, goal):
+    try:
+        value = evaluate(goal.args[0])
+    except Unbound as e:
+        suspend(mach, [e.var], goal)
+        return
+    except Undefined as _:
+        mach.state.fail()
+        return
+    if isinstance(value, SmallInteger):
+        cost = value.value
+    elif int_compare(value, wrap_int(0)) > 0:
+        cost = sys.maxint
+    else:
+        cost = -sys.maxint - 1
+    mach.state.add_cost(cost)
+
+@builtin("get_atts", 2)
+def builtin_get_atts(mach, program, goal):
+    var = goal.args[0]
+    spec = goal.args[1]
+    assert isinstance(var, Variable)
+    assert isinstance(spec, Compound)
+    val = None
+    if var.info is not None and var.info.attr is not None:
+        val = var.info.attr.get(spec.fsym, None)
+    if val is None:
+        mach.state.fail()
+    else:
+        if not mach.unify(val, spec):
+            mach.state.fail()
+
+@builtin("put_atts", 2)
+def builtin_put_atts(mach, program, goal):
+    var = goal.args[0]
+    spec = goal.args[1]
+    assert isinstance(spec, Compound)
+    mach.put_atts(var, spec.fsym, spec)
+
+@builtin("bind_hard", 2)
+def builtin_bind_hard(mach, program, goal):
+    var = goal.args[0]
+    val = goal.args[1]
+    if isinstance(var, Variable) and var.instance is var:
+        mach.bind_hard(var, val)
+    else:
+        if not mach.unify(var, val):
+            mach.state.fail()
+
+@builtin("list_atts", 2)
+def builtin_list_atts(mach, program, goal):
+    var = goal.args[0]
+    assert isinstance(var, Variable)
+    ret = goal.args[1]
+    res = Compound(NIL, [])
+    if var.info is not None and var.info.attr is not None:
+        for val in var.info.attr.itervalues():
+            res = Compound(CONS, [val, res])
+    if not mach.unify(ret, res):
+        mach.state.fail()
+
+@builtin("chr_resume", 3)
+def builtin_chr_resume(mach, program, goal):
+    chrid = goal.args[0]
+    assert isinstance(chrid, SmallInteger)
+    chrid = chrid.value
+    start = goal.args[1]
+    assert isinstance(start, SmallInteger)
+    start = start.value
+    search = goal.args[2]
+    assert isinstance(search, PartnerSearch)
+    # The constraint may have been removed by the time this runs.
+    if chrid in mach.chr_by_id:
+        chr_resume(chrid, start, mach, program, search.resumed())
+
+# Implementation of side effects in logic language
+# are bit of a question.
+# This looks like slightly wrong way to do it.
+@builtin("exit", 1)
+def builtin_exit(mach, program, goal):
+    a = goal.args[0].unroll()
+    if is_ground(a):
+        if isinstance(a, Integer):
+            raise Exiting(a.toint())
+        else:
+            mach.state.fail()
+    elif mach.chr_lock:
+        mach.state.fail()
+    else:
+        chr_add_constraint(goal, mach, program)
+
+@builtin("write", 1)
+def builtin_write(mach, program, goal):
+    a = goal.args[0].unroll()
+    if is_ground(a):
+        s = a.stringify()
+        os.write(1, s + "\n")
+    elif mach.chr_lock:
+        mach.state.fail()
+    else:
+        chr_add_constraint(goal, mach, program)
+
+@builtin("chr_revise", 1)
+def builtin_chr_revise(mach, program, goal):
+    a = goal.args[0]
+    assert isinstance(a, SmallInteger)
+    i = a.value
+    goal = mach.chr_by_id.get(i, None)
+    if goal is not None:
+        assert isinstance(goal, Compound)
+        if goal.fsym is WRITE and is_ground(goal.args[0]):
+            s = goal.args[0].stringify()
+            os.write(1, s + "\n")
+        elif goal.fsym is EXIT and is_ground(goal.args[0]):
+            code = goal.args[0].unroll()
+            if isinstance(code, Integer):
+                raise Exiting(code.toint())
             else:
-                chr_add_constraint(goal, mach, program)
-        elif goal.fsym is WRITE:
-            a = goal.args[0].unroll()
-            if is_ground(a):
-                s = a.stringify()
-                os.write(1, s + "\n")
-            elif mach.chr_lock:
                 mach.state.fail()
+        else:
+            suspend_on_vars(mach, goal, i)
+            mach.chr_refile(i)
+            chr_resume(i, 0, mach, program)
+
+@builtin("chr_printout", 0)
+def builtin_chr_printout(mach, program, goal):
+    for chrid, const in mach.chr_by_id.iteritems():
+        s = const.stringify()
+        os.write(1, "chr%d: %s\n" % (chrid, s))
+
+@builtin("DEF", 2)
+@builtin("LAST_DEF", 2)
+def builtin_def(mach, program, goal):
+    head = goal.args[0]
+    assert isinstance(head, Compound)
+    pos = goal.args[1]
+    assert isinstance(pos, SmallInteger)
+    pos = pos.value
+    pred = head.fsym.handler
+    assert isinstance(pred, Predicate)
+    clauses = pred.candidates(head)
+    height = mach.state.height()
+    if pos + 2 == len(clauses):
+        mach.state.choicepoint(mach,
+            [Compound(LAST_DEF, [head, wrap(pos + 1)])])
+    elif pos + 1 < len(clauses):
+        mach.state.choicepoint(mach,
+            [Compound(DEF, [head, wrap(pos + 1)])])
+    if pos < len(clauses):
+        invoke_clause(mach, head, clauses[pos], height)
+    else:
+        mach.state.fail()
+
+# Runs the compiled code of a clause against the goal. The head
+# instructions bind registers straight to the goal arguments, so
+# only the variables that the head introduces in write mode and the
+# body terms are allocated.
+#
+# A clause with a commit drops the choicepoints from 'height' up, the
+# remaining clauses among them, once the goals before the commit have
+# succeeded.
+def invoke_clause(mach, goal, clause, height):
+    code = jit.promote(clause).code
+    regs = [None] * code.nregs
+    t = mach.note()
+    if unify_head(mach, code, goal, regs):
+        goals = build_body(mach, code, regs)
+        if code.commit < 0:
+            mach.state.expand(goals)
+        else:
+            commit = code.commit
+            assert commit >= 0
+            mach.state.once(conjunction(goals[:commit]),
+                conjunction(goals[commit:]), height, mach.freeze_count)
+    else:
+        mach.undo(t)
+        mach.state.fail()
+
+@jit.unroll_safe
+def unify_head(mach, code, goal, regs):
+    ops = code.ops
+    stack = []
+    i = len(goal.args) - 1
+    while i >= 0:
+        stack.append(goal.args[i])
+        i -= 1
+    pc = 0
+    while pc < code.body_start:
+        op = ops[pc]
+        term = stack.pop()
+        if op == GET_VOID:
+            pc += 1
+        elif op == GET_VAR:
+            regs[ops[pc+1]] = term
+            pc += 2
+        elif op == GET_VAL:
+            if not unify(mach, regs[ops[pc+1]], term):
+                return False
+            pc += 2
+        elif op == GET_CONST:
+            if not unify(mach, code.consts[ops[pc+1]], term):
+                return False
+            pc += 2
+        elif op == GET_STRUCT:
+            fsym = code.functors[ops[pc+1]]
+            term = term.unroll()
+            if isinstance(term, Compound):
+                if term.fsym is not fsym:
+                    return False
+                i = len(term.args) - 1
+                while i >= 0:
+                    stack.append(term.args[i])
+                    i -= 1
+                pc += 3
+            elif isinstance(term, Variable):
+                end = ops[pc+2]
+                if not unify(mach, term, build_head(mach, code, pc, end, regs)):
+                    return False
+                pc = end
             else:
-                chr_add_constraint(goal, mach, program)
-        elif goal.fsym is CHR_REVISE:
-            revise = goal
-            a = goal.args[0]
-            assert isinstance(a, Integer)
-            i = a.bignum.toint()
-            goal = mach.chr_by_id.get(i, None)
-            if goal is not None:
-                assert isinstance(goal, Compound)
-                if goal.fsym is WRITE and is_ground(goal.args[0]):
-                    s = goal.args[0].stringify()
-                    os.write(1, s + "\n")
-                elif goal.fsym is EXIT and is_ground(goal.args[0]):
-                    if isinstance(a, Integer):
-                        raise Exiting(a.bignum.toint())
-                    else:
-                        mach.state.fail()
-                else:
-                    deep_freeze(mach, goal, revise, True)
-                    chr_resume(i, 0, mach, program)
-        elif goal.fsym is CHR_PRINTOUT:
-            for chrid, const in mach.chr_by_id.iteritems():
-                s = const.stringify()
-                os.write(1, "chr%d: %s\n" % (chrid, s))
+                return False
         else:
-            raise ValueError("unknown predicate: %s" % goal.stringify())
-        if debug:
-            print "=> " + mach.state.conj.stringify()
-        goal = mach.state.next_goal(mach)
+            raise ValueError("unify_head: bad instruction")
+    return True
+
+# When the head meets an unbound variable, the rest of the
+# subterm is constructed from the same instructions.
+@jit.unroll_safe
+def build_head(mach, code, pc, end, regs):
+    ops = code.ops
+    root = None
+    functors = []
+    argss = []
+    while pc < end:
+        op = ops[pc]
+        if op == GET_VOID:
+            term = mach.new_var()
+            pc += 1
+        elif op == GET_VAR:
+            term = mach.new_var()
+            regs[ops[pc+1]] = term
+            pc += 2
+        elif op == GET_VAL:
+            term = regs[ops[pc+1]]
+            pc += 2
+        elif op == GET_CONST:
+            term = code.consts[ops[pc+1]]
+            pc += 2
+        elif op == GET_STRUCT:
+            functors.append(code.functors[ops[pc+1]])
+            argss.append([])
+            pc += 3
+            continue
+        else:
+            raise ValueError("build_head: bad instruction")
+        # Completed subterms are attached to their parents,
+        # completing them in turn.
+        while len(argss) > 0:
+            args = argss[-1]
+            args.append(term)
+            if len(args) < functors[-1].arity:
+                break
+            term = Compound(functors.pop(), argss.pop())
+        if len(argss) == 0:
+            root = term
+    return root
+
+def build_body(mach, code, regs):
+    return build_goals(mach, code, code.body_start, regs)
+
+@jit.unroll_safe
+def build_goals(mach, code, pc, regs):
+    ops = code.ops
+    stack = []
+    goals = []
+    while True:
+        op = ops[pc]
+        if op == PUT_VOID:
+            stack.append(mach.new_var())
+            pc += 1
+        elif op == PUT_VAR:
+            var = mach.new_var()
+            regs[ops[pc+1]] = var
+            stack.append(var)
+            pc += 2
+        elif op == PUT_VAL:
+            stack.append(regs[ops[pc+1]])
+            pc += 2
+        elif op == PUT_CONST:
+            stack.append(code.consts[ops[pc+1]])
+            pc += 2
+        elif op == PUT_STRUCT:
+            fsym = code.functors[ops[pc+1]]
+            start = len(stack) - fsym.arity
+            assert start >= 0
+            args = stack[start:]
+            del stack[start:]
+            stack.append(Compound(fsym, args))
+            pc += 2
+        elif op == CALL:
+            goal = stack.pop().unroll()
+            if not isinstance(goal, Compound):
+                raise ValueError("callable term expected: %s" % goal.stringify())
+            goals.append(goal)
+            pc += 1
+        elif op == PROCEED:
+            return goals
+        else:
+            raise ValueError("build_goals: bad instruction")
 
 class Success(object):
     def signal(self, mach):
@@ -240,29 +1172,238 @@ class CondSuccess(Success):
         self.success = True
         return True
 
+# A search that is asked for one solution at a time stops at each of
+# them by raising Paused out of solve(). The search state stays as it
+# was, and failing it later resumes the search from its choicepoints.
+class Paused(Exception):
+    pass
+
+class Pausing(Success):
+    def signal(self, mach):
+        raise Paused()
+
+# Iterates over the solutions of a goal in a nested search, or in
+# the search given, which the goal then has to itself. The bindings
+# of a solution hold until the next call to next(), and close()
+# undoes the bindings of the whole iteration. The iteration may be
+# closed early. A limit of -1 means there is none.
+#
+#     solutions = Solutions(mach, program, goal, -1)
+#     while solutions.next():
+#         results.append(mach.variant(template))
+#     solutions.close()
+class Solutions(object):
+    def __init__(self, mach, program, goal, limit, search=None):
+        goal = goal.unroll()
+        if not isinstance(goal, Compound):
+            raise ValueError("callable term expected: %s" % goal.stringify())
+        self.mach = mach
+        self.program = program
+        self.limit = limit
+        self.count = 0
+        self.mark = mach.note()
+        mach.backtrack += 1
+        if search is None:
+            self.state = mach.state.subgoal(goal, [], Pausing())
+        else:
+            self.state = search.start(goal, Pausing())
+        self.started = False
+        self.finished = False
+        self.closed = False
+
+    def next(self):
+        if self.closed or self.finished or self.count == self.limit:
+            return False
+        if self.started:
+            self.state.fail()
+        self.started = True
+        this_state = self.mach.state
+        self.mach.state = self.state
+        try:
+            solve(self.mach, self.program)
+        except Paused as _:
+            self.count += 1
+        else:
+            self.finished = True
+        self.mach.state = this_state
+        return not self.finished
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.mach.undo(self.mark)
+            self.mach.backtrack -= 1
+            self.mach.trim()
+
+# A tabled predicate answers a call from a table that holds every
+# answer to it. Calls that are variants of each other share the
+# table, which is filled once by running the clauses to a fixpoint,
+# so a left-recursive definition terminates and a join is not worked
+# out again for every call.
+#
+# A call that meets its own table while the table is being filled
+# gets the answers found so far, and the clauses run again until a
+# round finds no new answers. Tables that met a table further down
+# the stack of evaluations depend on it, and complete together with
+# it, when it reaches its fixpoint. The answers are the bindings
+# only; constraints left waiting in a solution are not kept.
+TABLE_EVALUATING = 0
+TABLE_INCOMPLETE = 1
+TABLE_COMPLETE   = 2
+
+class TabledPredicate(Predicate):
+    _immutable_fields_ = ['tables']
+    def __init__(self, fsym, clauses):
+        Predicate.__init__(self, fsym, clauses)
+        self.tables = {}
+
+    def call(self, mach, program, goal):
+        key = variant_key(goal)
+        try:
+            table = self.tables[key]
+        except KeyError as _:
+            table = AnswerTable(mach.variant(goal))
+            self.tables[key] = table
+        if table.status == TABLE_EVALUATING:
+            top = program.evaluating[len(program.evaluating)-1]
+            top.low = min(top.low, table.depth)
+        elif table.status == TABLE_INCOMPLETE:
+            evaluate_table(mach, program, table)
+        # Like the clauses of a predicate, the answers are tried
+        # later when there is a choice between them.
+        if table.status == TABLE_COMPLETE and len(table.answers) < 2:
+            consume_answer(mach, goal, table, 0)
+        else:
+            mach.state.invoke(Compound(ANSWER, [goal, table, wrap(0)]))
+        return False
+
+class AnswerTable(Opaque):
+    def __init__(self, goal):
+        self.goal = goal
+        self.answers = []
+        self.ground = []
+        self.keys = {}
+        self.status = TABLE_INCOMPLETE
+        self.depth = 0
+        self.low = 0
+
+    def add(self, mach, program, answer):
+        key = variant_key(answer)
+        if key in self.keys:
+            return
+        self.keys[key] = None
+        self.answers.append(mach.variant(answer))
+        self.ground.append(is_ground(answer))
+        program.answer_count += 1
+
+    def stringify(self):
+        return "<table %s>" % self.goal.stringify()
+
+def evaluate_table(mach, program, table):
+    depth = len(program.evaluating)
+    start = len(program.incomplete)
+    table.status = TABLE_EVALUATING
+    table.depth = depth
+    table.low = depth
+    program.evaluating.append(table)
+    done = False
+    try:
+        count = -1
+        while count != program.answer_count:
+            count = program.answer_count
+            goal = mach.variant(table.goal)
+            solutions = Solutions(mach, program,
+                Compound(DEF, [goal, wrap(0)]), -1)
+            while solutions.next():
+                table.add(mach, program, goal)
+            solutions.close()
+        done = True
+    finally:
+        program.evaluating.pop()
+        if not done:
+            # The answers found are still answers,
+            # and the next call goes on from them.
+            table.status = TABLE_INCOMPLETE
+            del program.incomplete[start:]
+    if table.low < depth:
+        table.status = TABLE_INCOMPLETE
+        program.incomplete.append(table)
+        top = program.evaluating[len(program.evaluating)-1]
+        top.low = min(top.low, table.low)
+    else:
+        table.status = TABLE_COMPLETE
+        for other in program.incomplete[start:]:
+            other.status = TABLE_COMPLETE
+        del program.incomplete[start:]
+
+@builtin("ANSWER", 3)
+def builtin_answer(mach, program, goal):
+    table = goal.args[1]
+    assert isinstance(table, AnswerTable)
+    pos = goal.args[2]
+    assert isinstance(pos, SmallInteger)
+    consume_answer(mach, goal.args[0], table, pos.value)
+
+def consume_answer(mach, goal, table, pos):
+    if pos + 1 < len(table.answers):
+        mach.state.choicepoint(mach,
+            [Compound(ANSWER, [goal, table, wrap(pos + 1)])])
+    if pos < len(table.answers):
+        answer = table.answers[pos]
+        if not table.ground[pos]:
+            answer = mach.variant(answer)
+        if mach.unify(goal, answer):
+            return
+    mach.state.fail()
+
+# Variants have the same key: the term written in pre-order, with
+# the variables numbered by their first occurrence.
+def variant_key(term):
+    out = []
+    numbers = {}
+    stack = [term]
+    while len(stack) > 0:
+        t = stack.pop().unroll()
+        if isinstance(t, Compound):
+            out.append("%s/%d " % (t.fsym.name, t.fsym.arity))
+            i = len(t.args) - 1
+            while i >= 0:
+                stack.append(t.args[i])
+                i -= 1
+        elif isinstance(t, Variable):
+            try:
+                n = numbers[t]
+            except KeyError as _:
+                n = len(numbers)
+                numbers[t] = n
+            out.append("_%d " % n)
+        else:
+            out.append("#%s " % t.stringify())
+    return "".join(out)
+
 class Exiting(Exception):
     def __init__(self, status):
         self.status = status
 
 class CHR:
-    def __init__(self, name, pattern, keep, guard, goal):
+    _immutable_fields_ = ['ruleno', 'name', 'pattern[*]', 'keep', 'guard',
+                          'goal', 'occurrences[*]']
+    def __init__(self, ruleno, name, pattern, keep, guard, goal):
+        self.ruleno = ruleno
         self.name = name
         self.pattern = pattern
         self.keep  = keep
         self.guard = guard
         self.goal = goal
+        self.occurrences = [compile_occurrence(pattern, guard, goal, pivot)
+                            for pivot in range(len(pattern))]
 
-# TODO: Note that the constraint propagation doesn't exhaustively
-# try every combination there is. I'll probably add it in later.
-# TODO: When a constraint is added where there are free variables,
-#       the variables should freeze-in an element that re-activates
-#       a constraint. I'll probably add this later as well.
 def chr_add_constraint(goal, mach, program):
     assert isinstance(goal, Compound)
     chrid = mach.next_chrid
     mach.next_chrid += 1
     mach.chr_add_constraint(chrid, goal)
-    deep_freeze(mach, goal, Compound(CHR_REVISE, [wrap(chrid)]))
+    suspend_on_vars(mach, goal, chrid)
     #print 'start resolution:    %d %s' % (chrid, goal.stringify())
     # Without locking the database, we'd lose track
     # of constraints added and removed and
@@ -282,93 +1423,265 @@ def is_ground(val):
         return True
     return not isinstance(val, Variable)
 
-def deep_freeze(mach, val, goal, may_occur=False):
+def suspend_on_vars(mach, val, chrid):
     val = val.unroll()
     if isinstance(val, Compound):
         for arg in val.args:
-            deep_freeze(mach, arg, goal, may_occur)
+            suspend_on_vars(mach, arg, chrid)
     elif isinstance(val, Variable):
-        mach.freeze(val, goal, occurs_check=may_occur)
+        mach.suspend(val, chrid)
 
-def chr_resume(chrid, start, mach, program):
+def chr_resume(chrid, start, mach, program, search=None):
     fsym = mach.chr_by_id[chrid].fsym
     #print 'start resolution:    %d' % chrid
     assert not mach.chr_lock
     mach.chr_lock = True
-    constraint_resolution(fsym, chrid, mach, program)
+    constraint_resolution(fsym, chrid, mach, program, start, search)
     mach.chr_lock = False
     #print 'stopped  resolution: %d' % chrid
 
-def constraint_resolution(fsym, chrid, mach, program, start=0):
+# The active constraint is tried against its occurrences in turn, and
+# every occurrence against every combination of partners. When a rule
+# fires, its body runs first, and the search picks up where it left
+# off if the active constraint is still alive.
+def constraint_resolution(fsym, chrid, mach, program, start=0, search=None):
     constraints = program.constraints.get(fsym, [])
-    for rule, pivot in constraints[start:]:
+    while start < len(constraints):
+        rule, pivot = constraints[start]
         #print 'checking rule %s:%d' % (rule.name, pivot)
-        memo = execute_rule(rule, pivot, chrid, mach, program)
-        if memo is not None:
-            goal = mach.variant(rule.goal, memo)
-            #print 'success: ' + goal.stringify()
-            if rule.keep <= pivot: # The constraint did not survive.
-                return mach.state.expand([goal])
-            if start+1 >= len(constraints):
-                return mach.state.expand([goal])
-            return mach.state.expand([goal,
-                Compound(CHR_RESUME, [wrap(chrid), wrap(start+1)]) ])
+        if search is None:
+            search = PartnerSearch(rule, rule.occurrences[pivot], chrid)
+        goals = search.next_match(mach, program)
+        if goals is not None:
+            if chrid in mach.chr_by_id:
+                goals.append(Compound(CHR_RESUME,
+                    [wrap(chrid), wrap(start), search]))
+            return mach.state.expand(goals)
+        search = None
         start += 1
 
-def execute_rule(rule, pivot, chrid, mach, program):
-    active = {chrid:None}
-    vector = []
-    kills  = {}
-    memo = {}
-    if rule.keep <= pivot:
-        kills[chrid] = None
-    return search_partner(rule, 0, pivot, chrid, mach, program,
-        active, vector, kills, memo)
-
-def search_partner(rule, index, pivot, chrid, mach, program,
-        active, vector, kills, memo):
-    if index >= len(rule.pattern):
-        t = mach.note()
+# The state of matching one occurrence, kept between firings. It
+# travels inside the chr_resume goal, so it is never changed once it
+# is there: resuming works on a copy, and backtracking to an earlier
+# goal finds the state as it was.
+#
+# Every step has a snapshot of its candidates and the position of
+# the next one to try. Matching a step is undone through the trail
+# when the step moves on, but only back to the last firing, since
+# the body that ran in between cannot be undone. After a firing the
+# steps matched so far are matched again instead, as their
+# constraints may have died or changed.
+class PartnerSearch(Opaque):
+    def __init__(self, rule, code, chrid):
+        n = len(code.order)
+        self.rule = rule
+        self.code = code
+        self.candidates = [None] * n
+        self.candidates[0] = [chrid]
+        self.positions = [0] * n
+        self.vector = [-1] * len(rule.pattern)
+        self.step = 0
+        self.fired = False
+
+    def resumed(self):
+        n = len(self.code.order)
+        search = PartnerSearch(self.rule, self.code, -1)
+        search.candidates = self.candidates[:]
+        search.positions = self.positions[:]
+        search.vector = self.vector[:]
+        search.step = self.step
+        search.fired = self.fired
+        return search
+
+    # Returns the goals of the body if the rule fired.
+    def next_match(self, mach, program):
+        rule = self.rule
+        code = self.code
+        n = len(code.order)
+        regs = [None] * code.nregs
+        marks = [0] * n
+        step = self.step
+        if self.fired:
+            self.fired = False
+            step = self.rematch(mach, program, regs, marks)
+        while True:
+            if step == n:
+                if rule.keep == len(rule.pattern):
+                    key = HistoryKey(rule.ruleno, self.vector[:])
+                    fire = not mach.chr_step_history(key)
+                else:
+                    fire = True
+                if fire:
+                    self.step = n - 1
+                    self.fired = True
+                    for index in range(rule.keep, len(rule.pattern)):
+                        mach.chr_kill(self.vector[index])
+                    return build_body(mach, code, regs)
+                step -= 1
+                self.vector[code.order[step]] = -1
+                mach.undo(marks[step])
+                continue
+            candidates = self.candidates[step]
+            position = self.positions[step]
+            if position >= len(candidates):
+                if step == 0:
+                    self.step = 0
+                    return None
+                step -= 1
+                self.vector[code.order[step]] = -1
+                mach.undo(marks[step])
+                continue
+            self.positions[step] = position + 1
+            i = candidates[position]
+            if i not in mach.chr_by_id or i in self.vector:
+                continue
+            marks[step] = mach.note()
+            if not self.match_step(mach, program, step, i, regs):
+                mach.undo(marks[step])
+                continue
+            self.vector[code.order[step]] = i
+            step += 1
+            if step < n:
+                self.candidates[step] = self.lookup(mach, step, regs)
+                self.positions[step] = 0
+
+    # Matches the steps before the last one again, with the partners
+    # they had. Returns the first step that no longer matches, which
+    # then moves on to its next candidate.
+    def rematch(self, mach, program, regs, marks):
+        code = self.code
+        n = len(code.order)
+        for step in range(n - 1):
+            index = code.order[step]
+            i = self.vector[index]
+            self.vector[index] = -1
+            marks[step] = mach.note()
+            if i not in mach.chr_by_id or not self.match_step(
+                    mach, program, step, i, regs):
+                mach.undo(marks[step])
+                for later in range(step + 1, n):
+                    self.vector[code.order[later]] = -1
+                return step
+            self.vector[index] = i
+        self.vector[code.order[n - 1]] = -1
+        return n - 1
+
+    def match_step(self, mach, program, step, chrid, regs):
+        code = self.code
         mach.backtrack += 1
-        guard = mach.variant(rule.guard, memo)
-        csucc = CondSuccess()
-        this_state = mach.state
-        mach.state = mach.state.subgoal(guard, [], csucc)
-        solve(mach, program)
-        mach.state = this_state
+        ok = match_head(code, code.heads[step], code.ends[step],
+            mach.chr_by_id[chrid], regs)
+        if ok and code.guards[step] >= 0:
+            ok = check_guard(mach, program, code, code.guards[step], regs)
         mach.backtrack -= 1
-        if csucc.success:
-            if rule.keep == len(rule.pattern):
-                if mach.chr_step_history(list(vector)):
-                    return None
-            for k in kills.iterkeys():
-                mach.chr_kill(k)
-            return memo
+        return ok
+
+    def lookup(self, mach, step, regs):
+        code = self.code
+        fsym = self.rule.pattern[code.order[step]].fsym
+        candidates = None
+        argno = code.lookups[step]
+        if argno >= 0:
+            reg = code.key_regs[step]
+            if reg >= 0:
+                key = regs[reg]
+            else:
+                key = code.consts[code.key_consts[step]]
+            candidates = mach.chr_lookup(fsym, argno, key)
+        if candidates is None:
+            candidates = mach.chr_by_fsym.get(fsym, {})
+        return candidates.keys()
+
+    def stringify(self):
+        return "<%s>" % self.rule.name
+
+# The head instructions read as one-way matching: nothing in the
+# constraint is bound, and a structure only matches a structure.
+def match_head(code, pc, end, term, regs):
+    ops = code.ops
+    stack = []
+    assert isinstance(term, Compound)
+    i = len(term.args) - 1
+    while i >= 0:
+        stack.append(term.args[i])
+        i -= 1
+    while pc < end:
+        op = ops[pc]
+        term = stack.pop()
+        if op == GET_VOID:
+            pc += 1
+        elif op == GET_VAR:
+            regs[ops[pc+1]] = term
+            pc += 2
+        elif op == GET_VAL:
+            if not regs[ops[pc+1]].same(term):
+                return False
+            pc += 2
+        elif op == GET_CONST:
+            if not code.consts[ops[pc+1]].same(term):
+                return False
+            pc += 2
+        elif op == GET_STRUCT:
+            fsym = code.functors[ops[pc+1]]
+            term = term.unroll()
+            if not isinstance(term, Compound) or term.fsym is not fsym:
+                return False
+            i = len(term.args) - 1
+            while i >= 0:
+                stack.append(term.args[i])
+                i -= 1
+            pc += 3
         else:
-            mach.undo(t)
-            return None
-    if index == pivot:
-        if not rule.pattern[index].match(mach.chr_by_id[chrid], memo):
-            return None
-        vector.append(chrid)
-        ret = search_partner(rule, index+1, pivot, chrid,
-            mach, program, active, vector, kills, memo)
-        vector.pop()
-        return ret
-    slot = rule.pattern[index]
-    for i in mach.chr_by_fsym.get(slot.fsym, {}):
-        if i in active:
+            raise ValueError("match_head: bad instruction")
+    return True
+
+def check_guard(mach, program, code, pc, regs):
+    return solve_guard(mach, program, build_goals(mach, code, pc, regs))
+
+# A guard made of builtins with a guard test runs inline, in the state
+# of the goal that tests it. Anything else, a user predicate, a test
+# that has to wait, or a binding that wakes goals up, is undone and
+# the whole guard goes to a nested solve. The caller keeps
+# mach.backtrack raised, so that the bindings are trailed.
+def solve_guard(mach, program, goals):
+    t = mach.note()
+    result = inline_guard(mach, goals)
+    if result == GUARD_UNKNOWN:
+        mach.undo(t)
+        return nested_guard(mach, program, goals)
+    return result == GUARD_PASS
+
+@jit.unroll_safe
+def inline_guard(mach, goals):
+    this_state = mach.state
+    guard = InlineGuard(this_state.varmark)
+    mach.state = guard
+    pending = goals[:]
+    pending.reverse()
+    result = GUARD_PASS
+    while result == GUARD_PASS and len(pending) > 0:
+        goal = pending.pop()
+        if not isinstance(goal, Compound):
+            result = GUARD_UNKNOWN
+            break
+        if goal.fsym is AND:
+            pending.append(goal.args[1])
+            pending.append(goal.args[0])
             continue
-        memo_ = memo.copy()
-        if slot.match(mach.chr_by_id[i], memo_):
-            vector.append(i)
-            active[i] = None
-            if rule.keep <= index:
-                kills[i] = None
-            memo_ = search_partner(rule, index+1, pivot, chrid,
-                mach, program, active, vector, kills, memo_)
-            if memo_ is not None:
-                return memo_
-            active.pop(i)
-            vector.pop()
-    return None
+        handler = goal.fsym.handler
+        if isinstance(handler, Builtin) and handler.test is not None:
+            result = handler.test(mach, goal)
+        else:
+            result = GUARD_UNKNOWN
+        if guard.woken:
+            result = GUARD_UNKNOWN
+    mach.state = this_state
+    return result
+
+def nested_guard(mach, program, goals):
+    csucc = CondSuccess()
+    this_state = mach.state
+    mach.state = mach.state.subgoal(conjunction(goals), [], csucc)
+    solve(mach, program)
+    mach.state = this_state
+    return csucc.success
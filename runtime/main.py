@@ -1,7 +1,12 @@
 from objects import Atom, Compound, Variable, atom
+from objects import occurs_check_modes, search_modes, Search
 from rpython.rlib import rfile
+from rpython.rlib.rarithmetic import string_to_int
+from rpython.rlib.rstring import ParseStringError
+import image
 import machine
 import parser
+import server
 import os
 
 def new_entry_point(config):
@@ -10,20 +15,89 @@ def new_entry_point(config):
 MAIN = atom("main", 0)
 
 def main(argv):
-    if len(argv) <= 1:
+    args = []
+    occurs_check = occurs_check_modes["always"]
+    use_image = True
+    serve = False
+    socket_path = ""
+    search_mode = search_modes["ordered"]
+    depth = 1
+    steps = -1
+    for arg in argv[1:]:
+        if arg == "--no-image":
+            use_image = False
+        elif arg == "--serve":
+            serve = True
+        elif arg.startswith("--serve="):
+            serve = True
+            socket_path = arg[len("--serve="):]
+        elif arg.startswith("--occurs-check="):
+            mode = arg[len("--occurs-check="):]
+            if mode not in occurs_check_modes:
+                os.write(2, "unknown occurs check mode: %s\n" % mode)
+                return 1
+            occurs_check = occurs_check_modes[mode]
+        elif arg.startswith("--search="):
+            mode = arg[len("--search="):]
+            if mode not in search_modes:
+                os.write(2, "unknown search: %s\n" % mode)
+                return 1
+            search_mode = search_modes[mode]
+        elif arg.startswith("--depth="):
+            depth = bound(arg[len("--depth="):])
+            if depth <= 0:
+                os.write(2, "--depth takes a positive number\n")
+                return 1
+        elif arg.startswith("--steps="):
+            steps = bound(arg[len("--steps="):])
+            if steps <= 0:
+                os.write(2, "--steps takes a positive number\n")
+                return 1
+        else:
+            args.append(arg)
+    if len(args) == 0:
         return 1
 
-    fd = rfile.create_file(argv[1], 'rb')
+    fd = rfile.create_file(args[0], 'rb')
     try:
         source = fd.read()
     finally:
         fd.close()
 
-    code, next_varno = parser.parse(source)
+    # A warm start loads the program from its image instead of
+    # parsing it. The image is only a cache, so failing to write
+    # one is not an error.
+    state = parser.ParserState(0)
+    code, next_varno = None, 0
+    if use_image:
+        code, next_varno = image.read_image(args[0], source, state)
+    if code is None:
+        code, next_varno = parser.parse(source, state)
+        if use_image:
+            try:
+                image.write_image(args[0], source, code, next_varno)
+            except OSError as _:
+                pass
     program = machine.load(code)
+    program.occurs_check = occurs_check
+    program.search = Search(search_mode, depth, steps)
+
+    # A server keeps the program and answers queries
+    # instead of running main/0.
+    if serve and len(socket_path) > 0:
+        return server.serve_socket(program, state, socket_path)
+    elif serve:
+        server.serve_stdio(program, state)
+        return 0
     succ = machine.Success()
     try:
         program.solve(succ, Compound(MAIN, []), next_varno)
     except machine.Exiting as exit:
         return exit.status
     return 0
+
+def bound(s):
+    try:
+        return string_to_int(s)
+    except ParseStringError as _:
+        return 0
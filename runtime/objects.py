@@ -1,15 +1,29 @@
 from rpython.rlib.objectmodel import specialize, not_rpython, r_dict
 from rpython.rlib.rbigint import rbigint
-from rpython.rlib.rstring import NumberStringParser
-from rpython.rlib.rarithmetic import intmask
+from rpython.rlib.rstring import NumberStringParser, ParseStringOverflowError
+from rpython.rlib.rarithmetic import intmask, string_to_int, ovfcheck
+import sys
 
+# Terms are often handled as plain Objects, so the annotator moves
+# the fields of Compound here. They never change after construction.
 class Object:
-    pass
+    _immutable_fields_ = ['fsym', 'args']
+
+# The schedule of an atom tells OrderedSearch where its goals go.
+# Conjunctions are taken apart and true is dropped.
+SCHEDULE_DET    = 0
+SCHEDULE_UNIF   = 1
+SCHEDULE_NONDET = 2
+SCHEDULE_CONJ   = 3
+SCHEDULE_SKIP   = 4
 
 class Atom:
-    def __init__(self, name, arity):
+    _immutable_fields_ = ['name', 'arity', 'handler?', 'schedule']
+    def __init__(self, name, arity, schedule=SCHEDULE_DET):
         self.name = name
         self.arity = arity
+        self.handler = None
+        self.schedule = schedule
 
     def __repr__(self):
         return "{}".format(self.name, self.arity)
@@ -39,24 +53,6 @@ class Compound(Object):
             args.append(arg.copy(mach, memo))
         return Compound(self.fsym, args)
 
-    def match(self, t, memo):
-        if not isinstance(t, Compound):
-            return False
-        if not self.fsym is t.fsym:
-            return False
-        for i in range(self.fsym.arity):
-            if not self.args[i].match(t.args[i], memo):
-                return False
-        return True
-
-    def occurs(self, t):
-        if self is t:
-            return True
-        for arg in self.args:
-            if arg.occurs(t):
-                return True
-        return False
-
     def same(self, t):
         return t.unroll().same_compound(self)
 
@@ -68,66 +64,93 @@ class Compound(Object):
                 return False
         return True
 
-    def unify(self, mach, t):
-        return t.unify_compound(mach, self)
-
-    def unify_compound(self, mach, t):
-        if not self.fsym is t.fsym:
-            return False
-        for i in range(self.fsym.arity):
-            if not self.args[i].unify(mach, t.args[i]):
-                return False
-        return True
-
     def unroll(self):
         return self
 
+# Integers that fit a machine word are kept as SmallInteger, larger
+# ones as BigInteger. Every value has exactly one representation, so
+# integers of different classes are never equal.
 class Integer(Object):
-    def __init__(self, bignum):
-        self.bignum = bignum
+    def copy(self, mach, memo):
+        return self
 
-    def stringify(self):
-        return self.bignum.format(digits[:10])
+    def same_compound(self, other):
+        return False
 
-    def copy(self, mach, memo):
+    def unroll(self):
         return self
 
-    def match(self, t, memo):
-        if isinstance(t, Integer):
-            return self.bignum.eq(t.bignum)
+    def toint(self):
+        raise NotImplementedError
+
+    def tobigint(self):
+        raise NotImplementedError
+
+class SmallInteger(Integer):
+    _immutable_fields_ = ['value']
+    def __init__(self, value):
+        self.value = value
+
+    def stringify(self):
+        return str(self.value)
+
+    def same(self, t):
+        t = t.unroll()
+        if isinstance(t, SmallInteger):
+            return self.value == t.value
         return False
 
-    def occurs(self, t):
-        return self.same(t)
+    def toint(self):
+        return self.value
+
+    def tobigint(self):
+        return rbigint.fromint(self.value)
+
+class BigInteger(Integer):
+    _immutable_fields_ = ['bignum']
+    def __init__(self, bignum):
+        self.bignum = bignum
+
+    def stringify(self):
+        return self.bignum.format(digits[:10])
 
     def same(self, t):
         t = t.unroll()
-        if isinstance(t, Integer):
+        if isinstance(t, BigInteger):
             return self.bignum.eq(t.bignum)
         return False
 
-    def same_compound(self, other):
-        return False
+    def toint(self):
+        raise OverflowError
 
-    def unify(self, mach, t):
-        if isinstance(t, Integer):
-            return self.bignum.eq(t.bignum)
-        return t.unify(mach, self)
+    def tobigint(self):
+        return self.bignum
 
-    def unify_compound(self, mach, t):
-        return False
+SMALL_MIN = -16
+SMALL_MAX = 256
+small_integers = [SmallInteger(i) for i in range(SMALL_MIN, SMALL_MAX)]
 
-    def unroll(self):
-        return self
+def wrap_int(value):
+    if SMALL_MIN <= value < SMALL_MAX:
+        return small_integers[value - SMALL_MIN]
+    return SmallInteger(value)
+
+def wrap_bigint(bignum):
+    try:
+        return wrap_int(bignum.toint())
+    except OverflowError as _:
+        return BigInteger(bignum)
 
 def parse_integer(string, base=10):
     if base > 36:
         raise ValueError("Not enough digits to base")
     if base < 0:
         raise ValueError("Negative base")
-    literal = string
-    parser = NumberStringParser(string, literal, base, 'long')
-    return Integer(rbigint._from_numberstring_parser(parser))
+    try:
+        return wrap_int(string_to_int(string, base))
+    except ParseStringOverflowError as _:
+        parser = NumberStringParser(string, string, base, 'long')
+        return BigInteger(rbigint._from_numberstring_parser(parser))
 
 digits = "0123456789abcdefghijklmnopqrstuvwxyz"
 
@@ -135,13 +158,17 @@ class Variable(Object):
     def __init__(self, varno):
         self.instance = self
         self.varno = varno
-        self.goal = None
-        self.attr = {}
+        self.info = None
+
+    def get_info(self):
+        if self.info is None:
+            self.info = VariableInfo()
+        return self.info
 
     def stringify(self):
         if self.instance is self:
             return "_" + str(self.varno)
-        return self.instance.stringify()
+        return self.unroll().stringify()
 
     def copy(self, mach, memo):
         if self.instance is self:
@@ -151,78 +178,159 @@ class Variable(Object):
                 var = mach.new_var()
                 memo[self] = var
                 return var
-        return self.instance.copy(mach, memo)
-
-    def match(self, t, memo):
-        if self.instance is not self:
-            return self.instance.match(t, memo)
-        if self in memo:
-            return memo[self].same(t)
-        t = t.unroll()
-        if self is t:
-            return True
-        if t.occurs(self):
-            return False
-        memo[self] = t
-        return True
-
-    def occurs(self, t):
-        if self.instance is self:
-            return t is self
-        return self.instance.occurs(t)
+        return self.unroll().copy(mach, memo)
 
     def same(self, t):
         if self.instance is self:
             return self is t.unroll()
-        return self.instance.same(t)
+        return self.unroll().same(t)
 
     def same_compound(self, other):
         return False
 
-    def unify(self, mach, t):
-        if self.instance is not self:
-            return self.instance.unify(mach, t)
-        t = t.unroll()
-        if self is t:
-            return True
-        if t.occurs(self):
-            return False
-        mach.bind(self, t)
-        return True
+    def unroll(self):
+        t = self.instance
+        while isinstance(t, Variable) and t.instance is not t:
+            t = t.instance
+        return t
+
+# The frozen goals, suspended constraints and attributes of a variable
+# are kept aside, as only a few variables ever get any. The record is
+# created on first use and stays, empty or not.
+class VariableInfo(object):
+    def __init__(self):
+        self.goal = None
+        self.suspended = None
+        self.attr = None
+
+# Runtime records that travel inside goals, as the argument of a
+# builtin, are opaque terms. They are equal only to themselves and
+# are shared rather than copied.
+class Opaque(Object):
+    def stringify(self):
+        return "<opaque>"
+
+    def copy(self, mach, memo):
+        return self
+
+    def same(self, t):
+        return self is t.unroll()
 
-    def unify_compound(self, mach, t):
-        return self.unify(mach, t)
+    def same_compound(self, other):
+        return False
 
     def unroll(self):
-        if self.instance is self:
-            return self
+        return self
+
+# How unification treats a variable that is bound to a term it occurs
+# in. With OCCURS_CHECK_OLDER the check is skipped for a variable
+# introduced by the resolution step in progress, but only as long as
+# the step has neither bound an older variable nor copied a term.
+# Until then the new variables sit in nothing but the structures the
+# step is still building, and no term they are bound to can reach
+# them. Once an older variable is bound, say to f(V), a term leading
+# back to V can show up, and every binding is checked again.
+OCCURS_CHECK_ALWAYS = 0
+OCCURS_CHECK_NEVER  = 1
+OCCURS_CHECK_OLDER  = 2
+
+occurs_check_modes = {
+    "always": OCCURS_CHECK_ALWAYS,
+    "never":  OCCURS_CHECK_NEVER,
+    "older":  OCCURS_CHECK_OLDER,
+}
+
+# Unification and the occurs check work through an explicit stack,
+# so that long lists do not exhaust the machine stack.
+#
+# When two variables meet, the younger one is bound to the older one.
+# Binding chains then lead towards the oldest variables and stay
+# short, and the younger variable usually needs no trail entry.
+def unify(mach, a, b):
+    stack = [a, b]
+    while len(stack) > 0:
+        b = stack.pop().unroll()
+        a = stack.pop().unroll()
+        if a is b:
+            continue
+        if isinstance(a, Variable) and isinstance(b, Variable):
+            if a.varno < b.varno:
+                mach.bind(b, a)
+            else:
+                mach.bind(a, b)
+        elif isinstance(a, Variable):
+            if not bind_var(mach, a, b):
+                return False
+        elif isinstance(b, Variable):
+            if not bind_var(mach, b, a):
+                return False
+        elif isinstance(a, Compound):
+            if not isinstance(b, Compound) or a.fsym is not b.fsym:
+                return False
+            i = len(a.args) - 1
+            while i >= 0:
+                stack.append(a.args[i])
+                stack.append(b.args[i])
+                i -= 1
+        elif isinstance(a, Integer):
+            if not a.same(b):
+                return False
         else:
-            return self.instance.unroll()
+            return False
+    return True
+
+def bind_var(mach, var, t):
+    mode = mach.occurs_check
+    if mode == OCCURS_CHECK_ALWAYS or (
+            mode == OCCURS_CHECK_OLDER and (
+                var.varno < mach.step_varno or mach.step_shared)):
+        if occurs(var, t):
+            return False
+    mach.bind(var, t)
+    return True
+
+def occurs(x, term):
+    stack = [term]
+    while len(stack) > 0:
+        t = stack.pop().unroll()
+        if t is x:
+            return True
+        if isinstance(t, Compound):
+            for arg in t.args:
+                stack.append(arg)
+    return False
 
 known_atoms = {}
 
 @not_rpython
-def atom(name, arity):
+def atom(name, arity, schedule=SCHEDULE_DET):
     key = name, arity
     if key in known_atoms:
-        return known_atoms[key]
-    atom = Atom(name, arity)
+        atom = known_atoms[key]
+        assert schedule == SCHEDULE_DET or atom.schedule == schedule
+        return atom
+    atom = Atom(name, arity, schedule)
     known_atoms[key] = atom
     return atom
 
 NIL  = atom("nil", 0)
 CONS = atom(":", 2)
-AND = atom("and", 2)
-OR  = atom("or", 2)
-TRUE = atom("true", 0)
+AND = atom("and", 2, SCHEDULE_CONJ)
+OR  = atom("or", 2, SCHEDULE_NONDET)
+TRUE = atom("true", 0, SCHEDULE_SKIP)
 FALSE = atom("false", 0)
-DEF = atom("DEF", 2)
+DEF = atom("DEF", 2, SCHEDULE_NONDET)
+# The last clause left leaves no choice and runs with the det goals.
+LAST_DEF = atom("LAST_DEF", 2)
 
 UNIFY_ATTS = atom("unify_atts", 2)
 BIND_HARD = atom("bind_hard", 2)
 
-UNIFY = atom("=", 2)
-SAME = atom("same", 2)
+CHR_REVISE = atom("chr_revise", 1)
+COMMIT = atom("COMMIT", 1)
+
+UNIFY = atom("=", 2, SCHEDULE_UNIF)
+SAME = atom("same", 2, SCHEDULE_UNIF)
 
 success = Compound(TRUE, [])
 failure = Compound(FALSE, [])
@@ -245,22 +353,35 @@ def wrap(a):
     if isinstance(a, bool):
         return success if a else failure
     if isinstance(a, int):
-        return Integer(rbigint.fromint(a))
+        return wrap_int(a)
     assert False, ""
 
 # Any mutation to any data structure must be
-# recorded in the trail.
+# recorded in the trail, unless nothing could backtrack over it.
+# That is the case when there are no choicepoints and no nested
+# search is in progress (mach.backtrack == 0). Bindings are also
+# left out when the variable is younger than the latest choicepoint,
+# as no goal that backtracking restores can refer to it.
 class Trail:
     def __init__(self, state, next_varno):
         self.sofar = []
         self.state = state
         self.next_varno = next_varno
+        self.step_varno = next_varno
+        self.step_shared = False
+        self.occurs_check = OCCURS_CHECK_ALWAYS
         self.backtrack = 0
+        self.freeze_count = 0
+        self.resume_tag = -1
+        self.cond_mark = -1
         self.next_chrid = 0
         self.chr_by_id = {}
         self.chr_by_fsym = {}
-        self.chr_history_set = r_dict(hist_eq, hist_hash, force_non_null=True)
+        self.chr_history_set = r_dict(hist_eq, hist_key_hash, force_non_null=True)
         self.chr_occur = {}
+        self.chr_indexed = {}
+        self.chr_indexes = {}
+        self.chr_buckets = {}
         self.chr_debug = False
         self.chr_lock = False
 
@@ -268,14 +389,18 @@ class Trail:
         return len(self.sofar)
 
     def push(self, action):
-        # Concluded this might not work properly.
-        #if len(self.disj) > 0 or self.backtrack > 0:
-        self.sofar.append(action)
+        if self.backtrack > 0 or self.state.has_choicepoints():
+            self.sofar.append(action)
 
     def undo(self, whereto):
         while len(self.sofar) != whereto:
             self.sofar.pop().reset()
 
+    # Drops the entries once nothing can backtrack over them.
+    def trim(self):
+        if self.backtrack == 0 and not self.state.has_choicepoints():
+            del self.sofar[:]
+
     def new_var(self):
         var = Variable(self.next_varno)
         self.next_varno += 1
@@ -284,19 +409,21 @@ class Trail:
     def variant(self, obj, memo=None):
         if memo is None:
             memo = {}
+        self.step_shared = True
         return obj.copy(self, memo)
 
+    # On failure the trailed bindings are undone. The bindings that
+    # were not trailed are unreachable once the caller fails.
     def unify(self, a, b):
-        self.backtrack += 1
         t = self.note()
-        ret = a.unify(self, b)
+        ret = unify(self, a, b)
         if not ret:
             self.undo(t)
-        self.backtrack -= 1
         return ret
 
     def bind(self, this, value):
-        if len(this.attr) > 0:
+        info = this.info
+        if info is not None and info.attr is not None and len(info.attr) > 0:
             self.state.expand([
                 Compound(UNIFY_ATTS, [this, value]),
                 Compound(BIND_HARD, [this, value])
@@ -306,29 +433,58 @@ class Trail:
 
     def bind_hard(self, this, value):
         this.instance = value
-        self.push(Bound(this))
-        if this.goal is not None:
-            self.state.invoke(this.goal)
+        if this.varno < self.step_varno:
+            self.step_shared = True
+        if self.backtrack > 0 or this.varno < self.state.varmark:
+            self.sofar.append(Bound(this))
+        info = this.info
+        if info is not None:
+            if info.goal is not None:
+                self.state.invoke(info.goal)
+            if info.suspended is not None:
+                self.wake(info)
+
+    def freeze(self, this, goal):
+        assert isinstance(this, Variable)
+        info = this.get_info()
+        previous_goal = info.goal
+        if info.goal is None:
+            info.goal = goal
+        else:
+            info.goal = Compound(AND, [goal, info.goal])
+        self.push(Frozen(info, previous_goal))
 
-    def freeze(self, this, goal, occurs_check=False):
+    # Constraints wait on their variables in a suspension list,
+    # which holds every constraint once. A binding revises the live
+    # constraints and drops the dead ones from the list.
+    def suspend(self, this, chrid):
         assert isinstance(this, Variable)
-        if this.goal is None:
-            this.goal = goal
-        elif occurs_check and this.goal.occurs(goal):
+        info = this.get_info()
+        if info.suspended is None:
+            info.suspended = {}
+        elif chrid in info.suspended:
             return
-        else:
-            this.goal = Compound(AND, [goal, this.goal])
-        self.push(Frozen(this, this.goal))
+        info.suspended[chrid] = None
+        self.push(Suspended(info, chrid, True))
+
+    def wake(self, info):
+        for chrid in info.suspended.keys():
+            if chrid in self.chr_by_id:
+                self.state.invoke(Compound(CHR_REVISE, [wrap_int(chrid)]))
+            else:
+                info.suspended.pop(chrid)
+                self.push(Suspended(info, chrid, False))
 
     def chr_add_constraint(self, chrid, c):
         if self.chr_debug:
             print('added constraint %d' % chrid)
         self.chr_by_id[chrid] = c
-        self.chr_occur[chrid] = []
+        self.chr_occur[chrid] = {}
         try:
             self.chr_by_fsym[c.fsym][chrid] = None
         except KeyError as _:
             self.chr_by_fsym[c.fsym] = {chrid:None}
+        self.chr_file(chrid, c)
         self.push(AddedConstraint(self, chrid, c.fsym))
 
     def chr_kill(self, chrid):
@@ -339,7 +495,47 @@ class Trail:
             self.remove_vector(vector)
         cons = self.chr_by_id.pop(chrid)
         self.chr_by_fsym[cons.fsym].pop(chrid)
-        self.push(Killed(self, chrid, vectors, cons))
+        buckets = self.chr_unfile(chrid)
+        self.push(Killed(self, chrid, vectors, cons, buckets))
+
+    # The constraint store keeps an index for every argument position
+    # that some rule looks partners up by (chr_indexed, set by the
+    # program). Each live constraint remembers the buckets it is in,
+    # so it can be taken out again when it dies or its arguments
+    # become more instantiated.
+    def chr_file(self, chrid, c):
+        try:
+            indexes = self.chr_indexes[c.fsym]
+        except KeyError as _:
+            indexes = []
+            for argno in self.chr_indexed.get(c.fsym, []):
+                indexes.append(ConstraintIndex(argno))
+            self.chr_indexes[c.fsym] = indexes
+        buckets = []
+        for index in indexes:
+            bucket = index.bucket(c.args[index.argno])
+            bucket[chrid] = None
+            buckets.append(bucket)
+        self.chr_buckets[chrid] = buckets
+
+    def chr_unfile(self, chrid):
+        buckets = self.chr_buckets.pop(chrid)
+        for bucket in buckets:
+            bucket.pop(chrid)
+        return buckets
+
+    def chr_refile(self, chrid):
+        buckets = self.chr_unfile(chrid)
+        self.chr_file(chrid, self.chr_by_id[chrid])
+        self.push(Refiled(self, chrid, buckets))
+
+    # Returns the constraints that may have 'key' at the argument,
+    # or None if the whole store has to be searched.
+    def chr_lookup(self, fsym, argno, key):
+        for index in self.chr_indexes.get(fsym, []):
+            if index.argno == argno:
+                return index.lookup(key)
+        return None
 
     def chr_step_history(self, vector):
         if vector in self.chr_history_set:
@@ -350,27 +546,77 @@ class Trail:
 
     def put_atts(self, var, fsym, value):
         assert isinstance(var, Variable)
+        info = var.get_info()
+        if info.attr is None:
+            info.attr = {}
         try:
-            prev = var.attr[fsym]
+            prev = info.attr[fsym]
         except KeyError as _:
             prev = None
-        var.attr[fsym] = value
-        self.push(PutAtts(var, fsym, prev))
+        info.attr[fsym] = value
+        self.push(PutAtts(info, fsym, prev))
 
+    # Every live constraint knows the history entries it takes part
+    # in, and an entry is dropped as soon as one of them dies, as it
+    # can never match again.
     def add_vector(self, vector):
         self.chr_history_set[vector] = None
-        for chrid in vector:
-            self.chr_occur[chrid].append(vector)
+        for chrid in vector.ids:
+            self.chr_occur[chrid][vector] = None
 
     def remove_vector(self, vector):
         self.chr_history_set.pop(vector)
-        for chrid in vector:
+        for chrid in vector.ids:
             try:
                 occurs = self.chr_occur[chrid]
             except KeyError as _:
                 pass
             else:
-                occurs.remove(vector)
+                occurs.pop(vector)
+
+# Constraints are filed by the principal functor, the integer value
+# or the identity of an unbound variable at the argument. These are
+# exactly the cases that head matching tells apart at the top level.
+# Big integers are left in 'other' and make the lookup fall back to
+# searching the whole store.
+class ConstraintIndex:
+    def __init__(self, argno):
+        self.argno = argno
+        self.functors = {}
+        self.integers = {}
+        self.variables = {}
+        self.other = {}
+
+    def bucket(self, arg):
+        arg = arg.unroll()
+        if isinstance(arg, Compound):
+            return get_bucket(self.functors, arg.fsym)
+        elif isinstance(arg, SmallInteger):
+            return get_bucket(self.integers, arg.value)
+        elif isinstance(arg, Variable):
+            return get_bucket(self.variables, arg)
+        return self.other
+
+    def lookup(self, key):
+        key = key.unroll()
+        if isinstance(key, Compound):
+            return self.functors.get(key.fsym, no_constraints)
+        elif isinstance(key, SmallInteger):
+            return self.integers.get(key.value, no_constraints)
+        elif isinstance(key, Variable):
+            return self.variables.get(key, no_constraints)
+        return None
+
+no_constraints = {}
+
+@specialize.argtype(1)
+def get_bucket(table, key):
+    try:
+        return table[key]
+    except KeyError as _:
+        bucket = {}
+        table[key] = bucket
+        return bucket
 
 class Action(object):
     pass
@@ -383,12 +629,24 @@ class Bound(Action):
         self.this.instance = self.this
 
 class Frozen(Action):
-    def __init__(self, this, previous_goal):
-        self.this = this
+    def __init__(self, info, previous_goal):
+        self.info = info
         self.previous_goal = previous_goal
 
     def reset(self):
-        self.this.goal = self.previous_goal
+        self.info.goal = self.previous_goal
+
+class Suspended(Action):
+    def __init__(self, info, chrid, added):
+        self.info = info
+        self.chrid = chrid
+        self.added = added
+
+    def reset(self):
+        if self.added:
+            self.info.suspended.pop(self.chrid)
+        else:
+            self.info.suspended[self.chrid] = None
 
 class AddedConstraint(Action):
     def __init__(self, mach, chrid, fsym):
@@ -399,37 +657,54 @@ class AddedConstraint(Action):
     def reset(self):
         self.mach.chr_by_id.pop(self.chrid)
         self.mach.chr_by_fsym[self.fsym].pop(self.chrid)
+        self.mach.chr_unfile(self.chrid)
         if self.mach.chr_debug:
             print('- removed constraint', self.chrid)
 
 class Killed(Action):
-    def __init__(self, mach, chrid, vectors, cons):
+    def __init__(self, mach, chrid, vectors, cons, buckets):
         self.mach  = mach
         self.chrid = chrid
         self.vectors = vectors
         self.cons = cons
+        self.buckets = buckets
 
     def reset(self):
+        self.mach.chr_occur[self.chrid] = {}
         for vector in self.vectors:
             self.mach.add_vector(vector)
-        self.mach.chr_occur[self.chrid] = self.vectors
         self.mach.chr_by_id[self.chrid] = self.cons
         self.mach.chr_by_fsym[self.cons.fsym][self.chrid] = None
+        for bucket in self.buckets:
+            bucket[self.chrid] = None
+        self.mach.chr_buckets[self.chrid] = self.buckets
         if self.mach.chr_debug:
             print('- removed kill %d' % self.chrid)
 
+class Refiled(Action):
+    def __init__(self, mach, chrid, buckets):
+        self.mach = mach
+        self.chrid = chrid
+        self.buckets = buckets
+
+    def reset(self):
+        self.mach.chr_unfile(self.chrid)
+        for bucket in self.buckets:
+            bucket[self.chrid] = None
+        self.mach.chr_buckets[self.chrid] = self.buckets
+
 class PutAtts(Action):
-    def __init__(self, var, fsym, prev):
-        self.var = var
+    def __init__(self, info, fsym, prev):
+        self.info = info
         self.fsym = fsym
         self.prev = prev
 
     def reset(self):
         prev = self.prev
         if prev is None:
-            self.var.attr.pop(self.fsym)
+            self.info.attr.pop(self.fsym)
         else:
-            self.var.attr[self.fsym] = prev
+            self.info.attr[self.fsym] = prev
 
 class Propagated(Action):
     def __init__(self, mach, vector):
@@ -439,29 +714,82 @@ class Propagated(Action):
     def reset(self):
         self.mach.remove_vector(self.vector)
 
+# A propagation history entry: the rule that fired and the
+# constraints matched by its heads, in rule order. The hash is
+# computed once, when the entry is made.
+class HistoryKey(object):
+    _immutable_fields_ = ['ruleno', 'ids[*]', 'hash']
+    def __init__(self, ruleno, ids):
+        self.ruleno = ruleno
+        self.ids = ids
+        self.hash = hist_hash(ruleno, ids)
+
 def hist_eq(a, b):
-    return a == b
-    
-def hist_hash(a):
+    if a.hash != b.hash or a.ruleno != b.ruleno:
+        return False
+    for i in range(len(a.ids)):
+        if a.ids[i] != b.ids[i]:
+            return False
+    return True
+
+def hist_hash(ruleno, ids):
     mult = 1000003
-    x = 0x345678
-    z = len(a)
-    for chrid in a:
+    x = 0x345678 ^ ruleno
+    z = len(ids)
+    for chrid in ids:
         y = chrid
-        x = (x ^ y) * mult
+        x = intmask((x ^ y) * mult)
         z -= 1
         mult += 82520 + z + z
     x += 97531
     return intmask(x)
 
+def hist_key_hash(a):
+    return a.hash
+
+# The strategies keep 'varmark', the next variable number at the
+# time the latest choicepoint was created. Each choicepoint records
+# the mark that was in effect before it.
+# The strategies keep their choicepoints in lists of different
+# shapes, so every one of them answers for its own.
 class SearchStrategy(object):
-    pass
+    def has_choicepoints(self):
+        raise NotImplementedError("SearchStrategy.has_choicepoints")
+
+    def height(self):
+        raise NotImplementedError("SearchStrategy.height")
+
+    # The pending goals, for the trace that solve() prints.
+    def describe(self):
+        raise NotImplementedError("SearchStrategy.describe")
+
+    # The mark of the outermost barrier that once/1, if/3 or a commit
+    # in a clause body has yet to pass in the current branch, or -1.
+    def guard_mark(self):
+        raise NotImplementedError("SearchStrategy.guard_mark")
+
+    # cost/1 only means something to best-first search.
+    def add_cost(self, cost):
+        pass
 
 class DepthFirstSearch(SearchStrategy):
     def __init__(self, conj, disj, cb):
         self.conj = conj
         self.disj = disj
         self.cb   = cb
+        self.varmark = 0
+
+    def has_choicepoints(self):
+        return len(self.disj) > 0
+
+    def height(self):
+        return len(self.disj)
+
+    def describe(self):
+        return self.conj.stringify()
+
+    def guard_mark(self):
+        return pending_mark(self.conj)
 
     def next_goal(self, mach):
         assert isinstance(self.conj, Compound)
@@ -478,8 +806,9 @@ class DepthFirstSearch(SearchStrategy):
         elif self.conj.fsym is FALSE:
             if len(self.disj) == 0:
                 return None
-            t, self.conj = self.disj.pop()
+            t, self.varmark, self.conj = self.disj.pop()
             mach.undo(t)
+            mach.trim()
             return self.next_goal(mach)
         else:
             goal = self.conj
@@ -499,87 +828,646 @@ class DepthFirstSearch(SearchStrategy):
         conj = self.conj
         for goal in reversed(goals):
             conj = Compound(AND, [goal, conj])
-        self.disj.append((mach.note(), conj))
+        self.disj.append((mach.note(), self.varmark, conj))
+        self.varmark = mach.next_varno
 
     def fail(self):
         self.conj = failure
 
+    def once(self, goal, then, height, mark):
+        barrier = Barrier(height, mark, None, None, None)
+        self.conj = committed(goal, barrier, then, self.conj)
+
+    def commit(self, mach, barrier):
+        if len(self.disj) > barrier.height:
+            self.varmark = self.disj[barrier.height][1]
+            del self.disj[barrier.height:]
+
     def subgoal(self, conj, disj, cb):
-        return DepthFirstSearch(conj, disj, cb)
+        return DepthFirstSearch(conj, [], cb)
+
+# The goal stacks are immutable linked lists, so that a choicepoint
+# shares them instead of copying them.
+class GoalStack(object):
+    _immutable_fields_ = ['goal', 'next']
+    def __init__(self, goal, next):
+        self.goal = goal
+        self.next = next
+
+def describe_stack(stack):
+    out = []
+    while stack is not None:
+        out.append(stack.goal.stringify())
+        stack = stack.next
+    return "[" + ", ".join(out) + "]"
+
+# The goal, then the commit to it, then the rest.
+def committed(goal, barrier, then, conj):
+    commit = Compound(COMMIT, [barrier])
+    return Compound(AND, [goal,
+        Compound(AND, [commit, Compound(AND, [then, conj])])])
+
+# The last commit in the conjunction belongs to the outermost goal.
+def pending_mark(conj):
+    mark = -1
+    while isinstance(conj, Compound) and conj.fsym is AND:
+        goal = conj.args[0]
+        if isinstance(goal, Compound) and goal.fsym is COMMIT:
+            barrier = goal.args[0]
+            assert isinstance(barrier, Barrier)
+            mark = barrier.mark
+        conj = conj.args[1]
+    return mark
+
+# once/1, if/3 and the commit in a clause body prune through a
+# barrier. It is the argument of the COMMIT goal that runs after the
+# goal that is committed to, and it holds the number of choicepoints
+# to keep, with the goals that were pending when OrderedSearch set
+# the goal apart. Best-first search keeps the scope of the goal in
+# it instead. The mark is mach.freeze_count when the goal started,
+# so that the goals frozen before it can be told apart.
+class Barrier(Opaque):
+    _immutable_fields_ = ['height', 'mark', 'unif', 'det', 'nondet']
+    def __init__(self, height, mark, unif, det, nondet):
+        self.height = height
+        self.mark = mark
+        self.unif = unif
+        self.det = det
+        self.nondet = nondet
+        self.scope = None
+
+    def stringify(self):
+        return "<barrier %d>" % self.height
 
 class OrderedSearch(SearchStrategy):
     def __init__(self, conj, disj, cb):
-        self.unif   = []
-        self.det    = [conj]
-        self.nondet = []
+        self.unif   = None
+        self.det    = GoalStack(conj, None)
+        self.nondet = None
         self.disj   = disj
         self.cb     = cb 
+        self.varmark = 0
+
+    def has_choicepoints(self):
+        return len(self.disj) > 0
+
+    def height(self):
+        return len(self.disj)
+
+    def describe(self):
+        return "unif: %s det: %s nondet: %s" % (describe_stack(self.unif),
+            describe_stack(self.det), describe_stack(self.nondet))
+
+    # A commit sits at the bottom of the nondet stack, and the stack
+    # of the goal around it is kept in its barrier.
+    def guard_mark(self):
+        mark = -1
+        stack = self.nondet
+        while stack is not None:
+            goal = stack.goal
+            if goal.fsym is COMMIT:
+                barrier = goal.args[0]
+                assert isinstance(barrier, Barrier)
+                mark = barrier.mark
+                stack = barrier.nondet
+            else:
+                stack = stack.next
+        return mark
 
     def next_goal(self, mach):
-        if len(self.unif) > 0:
-            goal = self.unif.pop()
-        elif len(self.det) > 0:
-            goal = self.det.pop()
-        elif len(self.nondet) > 0:
-            goal = self.nondet.pop()
+        if self.unif is not None:
+            goal = self.unif.goal
+            self.unif = self.unif.next
+        elif self.det is not None:
+            goal = self.det.goal
+            self.det = self.det.next
+        elif self.nondet is not None:
+            goal = self.nondet.goal
+            self.nondet = self.nondet.next
         else:
             if self.cb.signal(self):
                 self.disj = []
                 return None
             else:
-                self.unif.append(failure)
+                self.fail()
                 return self.next_goal(mach)
         if goal.fsym is FALSE:
             if len(self.disj) == 0:
                 return None
-            t, self.unif, self.det, self.nondet = self.disj.pop()
+            t, self.varmark, self.unif, self.det, self.nondet = self.disj.pop()
             mach.undo(t)
+            mach.trim()
             return self.next_goal(mach)
         return goal
 
     def invoke(self, goal):
-        if isinstance(goal, Compound) and goal.fsym is TRUE:
+        if not isinstance(goal, Compound):
+            self.det = GoalStack(goal, self.det)
             return
-        elif isinstance(goal, Compound) and goal.fsym is AND:
+        schedule = goal.fsym.schedule
+        if schedule == SCHEDULE_DET:
+            self.det = GoalStack(goal, self.det)
+        elif schedule == SCHEDULE_UNIF:
+            self.unif = GoalStack(goal, self.unif)
+        elif schedule == SCHEDULE_NONDET:
+            self.nondet = GoalStack(goal, self.nondet)
+        elif schedule == SCHEDULE_CONJ:
             self.invoke(goal.args[1])
             self.invoke(goal.args[0])
-        elif  isinstance(goal, Compound) and goal.fsym is OR:
-            self.nondet.append(goal)
-        elif  isinstance(goal, Compound) and goal.fsym is DEF:
-            if is_small_list(goal.args[1]):
-                self.det.append(goal)
-            else:
-                self.nondet.append(goal)
-        elif  isinstance(goal, Compound) and goal.fsym is UNIFY:
-            self.unif.append(goal)
-        elif  isinstance(goal, Compound) and goal.fsym is SAME:
-            self.unif.append(goal)
-        else:
-            self.det.append(goal)
 
     def expand(self, goals):
         for goal in reversed(goals):
             self.invoke(goal)
 
     def choicepoint(self, mach, goals):
-        unif   = list(self.unif)
-        det    = list(self.det)
-        nondet = list(self.nondet)
+        unif   = self.unif
+        det    = self.det
+        nondet = self.nondet
         self.expand(goals)
-        self.disj.append((mach.note(), self.unif, self.det, self.nondet))
+        self.disj.append((mach.note(), self.varmark,
+            self.unif, self.det, self.nondet))
+        self.varmark = mach.next_varno
         self.unif   = unif
         self.det    = det
         self.nondet = nondet
 
     def fail(self):
-        self.unif.append(failure)
+        self.unif = GoalStack(failure, self.unif)
+
+    # The goal runs on stacks of its own, over the commit at the bottom
+    # of the nondet stack, so that all of its goals run before the
+    # commit does. The commit then puts back the pending goals, with
+    # 'then' on top of them.
+    def once(self, goal, then, height, mark):
+        self.invoke(then)
+        barrier = Barrier(height, mark, self.unif, self.det, self.nondet)
+        self.unif = None
+        self.det = None
+        self.nondet = GoalStack(Compound(COMMIT, [barrier]), None)
+        self.invoke(goal)
+
+    def commit(self, mach, barrier):
+        if len(self.disj) > barrier.height:
+            self.varmark = self.disj[barrier.height][1]
+            del self.disj[barrier.height:]
+        self.unif = barrier.unif
+        self.det = barrier.det
+        self.nondet = barrier.nondet
 
     def subgoal(self, conj, disj, cb):
         return OrderedSearch(conj, disj, cb)
 
-def is_small_list(a):
-    a1 = a.args[1]
-    if isinstance(a1, Compound) and a1.fsym is CONS:
-        a2 = a1.args[1]
-        return isinstance(a2, Compound) and a2.fsym is NIL
-    return False
+# The strategies below run the goals of a branch in the order they
+# are written, like DepthFirstSearch, and differ in which branch
+# they go on with. They do not restore the constraint store, the
+# frozen goals or the attributes when they change branches, and are
+# meant for programs without them. Nested searches use OrderedSearch.
+#
+# Iterative deepening searches depth-first in rounds. A round cuts
+# off the branches that make more than 'depth' choices, or that run
+# more than 'steps' goals when steps is not -1, and the next round
+# raises both bounds by as much again. A solution is reported in the
+# round that first reaches it, and the search ends with the first
+# round that cuts nothing off.
+#
+# A goal that fails after a cut off has not failed for good, so the
+# alternatives that a commit after it would take away, the else of
+# if/3 or the clauses after the one that commits, are cut off too.
+class IterativeDeepening(DepthFirstSearch):
+    def __init__(self, conj, cb, depth, steps):
+        DepthFirstSearch.__init__(self, conj, [], cb)
+        self.root = conj
+        self.bounds = []
+        self.scopes = []
+        self.depth = 0
+        self.steps = 0
+        self.depth_bound = depth
+        self.steps_bound = steps
+        self.depth_step = depth
+        self.steps_step = steps
+        self.depth_seen = -1
+        self.steps_seen = -1
+        self.cutoffs = 0
+        self.blocked = False
+        self.started = False
+        self.mark = 0
+        self.rootmark = 0
+
+    # Every binding is trailed, so that a round can start over.
+    def has_choicepoints(self):
+        return True
+
+    def next_goal(self, mach):
+        if not self.started:
+            self.started = True
+            self.mark = mach.note()
+            self.rootmark = mach.next_varno
+            self.varmark = self.rootmark
+        if self.blocked:
+            self.blocked = False
+            self.conj = failure
+        while True:
+            conj = self.conj
+            assert isinstance(conj, Compound)
+            if conj.fsym is TRUE:
+                if self.depth > self.depth_seen or (
+                        self.steps_bound >= 0 and
+                        self.steps > self.steps_seen):
+                    if self.cb.signal(self):
+                        self.disj = []
+                        self.bounds = []
+                        return None
+                self.conj = failure
+            elif conj.fsym is FALSE:
+                self.leave_scopes()
+                if len(self.disj) > 0:
+                    t, self.varmark, self.conj = self.disj.pop()
+                    self.depth, self.steps = self.bounds.pop()
+                    mach.undo(t)
+                elif self.cutoffs > 0:
+                    self.next_round(mach)
+                else:
+                    return None
+            elif self.steps_bound >= 0 and self.steps >= self.steps_bound:
+                self.cutoffs += 1
+                self.conj = failure
+            else:
+                self.steps += 1
+                if conj.fsym is AND:
+                    self.conj = conj.args[1]
+                    return conj.args[0]
+                self.conj = success
+                return conj
+
+    # The goal of a scope has failed once backtracking reaches below
+    # the choicepoints it made.
+    def leave_scopes(self):
+        while len(self.scopes) > 0:
+            barrier, opened, cutoffs = self.scopes[-1]
+            if len(self.disj) > opened:
+                break
+            self.scopes.pop()
+            if self.cutoffs > cutoffs:
+                height = barrier.height
+                assert height >= 0
+                del self.disj[height:]
+                del self.bounds[height:]
+
+    def next_round(self, mach):
+        mach.undo(self.mark)
+        self.varmark = self.rootmark
+        self.conj = self.root
+        self.scopes = []
+        self.depth = 0
+        self.steps = 0
+        self.cutoffs = 0
+        self.depth_seen = self.depth_bound
+        self.steps_seen = self.steps_bound
+        self.depth_bound += self.depth_step
+        if self.steps_bound >= 0:
+            self.steps_bound += self.steps_step
+
+    # At the depth bound both ways out of the choice are cut off. The
+    # goals that follow are dropped before the next one runs.
+    def choicepoint(self, mach, goals):
+        if self.depth >= self.depth_bound:
+            self.cutoffs += 1
+            self.blocked = True
+            return
+        self.depth += 1
+        DepthFirstSearch.choicepoint(self, mach, goals)
+        self.bounds.append((self.depth, self.steps))
+
+    def once(self, goal, then, height, mark):
+        barrier = Barrier(height, mark, None, None, None)
+        self.scopes.append((barrier, len(self.disj), self.cutoffs))
+        self.conj = committed(goal, barrier, then, self.conj)
+
+    def commit(self, mach, barrier):
+        DepthFirstSearch.commit(self, mach, barrier)
+        del self.bounds[len(self.disj):]
+        while len(self.scopes) > 0:
+            other, _, _ = self.scopes.pop()
+            if other is barrier:
+                break
+
+    def subgoal(self, conj, disj, cb):
+        return OrderedSearch(conj, disj, cb)
+
+# Costs stop at the bounds of a machine word instead of wrapping
+# around, so a branch that costs too much to count still goes last.
+def cost_add(x, y):
+    try:
+        return ovfcheck(x + y)
+    except OverflowError as _:
+        if y > 0:
+            return sys.maxint
+        return -sys.maxint - 1
+
+# Best-first search keeps the branches it has not taken in a priority
+# queue, as copies of the goals they have left and of the query they
+# answer, and always goes on with the cheapest one. A branch costs
+# what cost/1 has added up along it, and branches that cost the same
+# are taken in the order they were made. Breadth-first search is the
+# same with every choice costing one.
+class SearchNode(object):
+    _immutable_fields_ = ['cost', 'seq', 'scope', 'pair']
+    def __init__(self, cost, seq, scope, pair):
+        self.cost = cost
+        self.seq = seq
+        self.scope = scope
+        self.pair = pair
+
+    def before(self, other):
+        if self.cost != other.cost:
+            return self.cost < other.cost
+        return self.seq < other.seq
+
+# The goal of once/1, of if/3 and before a commit runs in a scope,
+# which counts the branches that are still searching for it. The
+# alternatives that the commit would take away, the else of if/3 or
+# the clauses after the one that commits, wait in the scope and are
+# only let out once no branch is left in it.
+class Scope(object):
+    _immutable_fields_ = ['parent']
+    def __init__(self, parent, deferred):
+        self.parent = parent
+        self.deferred = deferred
+        self.live = 1
+
+    def within(self, other):
+        scope = self
+        while scope is not None:
+            if scope is other:
+                return True
+            scope = scope.parent
+        return False
+
+class BestFirstSearch(SearchStrategy):
+    def __init__(self, conj, cb):
+        self.conj = conj
+        self.cb = cb
+        self.query = conj
+        self.answer = conj
+        self.queue = []
+        self.pending = []
+        self.seq = 0
+        self.cost = 0
+        self.choice_cost = 0
+        self.scope = None
+        self.started = False
+        self.mark = 0
+        self.rootmark = 0
+        self.varmark = 0
+
+    # Every binding is trailed, so that the search can change branches.
+    def has_choicepoints(self):
+        return True
+
+    def height(self):
+        return 0
+
+    def describe(self):
+        return "%s (%d queued)" % (self.conj.stringify(), len(self.queue))
+
+    def guard_mark(self):
+        return pending_mark(self.conj)
+
+    def add_cost(self, cost):
+        self.cost = cost_add(self.cost, cost)
+
+    def next_goal(self, mach):
+        if not self.started:
+            self.started = True
+            self.mark = mach.note()
+            self.rootmark = mach.next_varno
+            self.varmark = self.rootmark
+        if len(self.pending) > 0:
+            self.branch_out(mach)
+        while True:
+            conj = self.conj
+            assert isinstance(conj, Compound)
+            if conj.fsym is AND:
+                self.conj = conj.args[1]
+                return conj.args[0]
+            elif conj.fsym is TRUE:
+                if mach.unify(self.query, self.answer) and self.cb.signal(self):
+                    self.queue = []
+                    return None
+                self.conj = failure
+            elif conj.fsym is FALSE:
+                self.branch_failed()
+                if len(self.queue) == 0:
+                    return None
+                self.resume(mach, heap_pop(self.queue))
+            else:
+                self.conj = success
+                return conj
+
+    # The branch that made choices goes into the queue together with
+    # its alternatives, ahead of them, and the search goes on with
+    # whichever branch is cheapest now.
+    def branch_out(self, mach):
+        pending = self.pending
+        self.pending = []
+        self.enqueue(mach.variant(Compound(AND, [self.answer, self.conj])),
+            self.scope)
+        for pair in pending:
+            self.enqueue(pair, self.scope)
+        scope = self.scope
+        while scope is not None:
+            scope.live += len(pending)
+            scope = scope.parent
+        self.resume(mach, heap_pop(self.queue))
+
+    def branch_failed(self):
+        delta = -1
+        scope = self.scope
+        while scope is not None:
+            scope.live += delta
+            if scope.live == 0 and len(scope.deferred) > 0:
+                for pair in scope.deferred:
+                    self.enqueue(pair, scope.parent)
+                delta += len(scope.deferred)
+                scope.deferred = []
+            scope = scope.parent
+
+    def enqueue(self, pair, scope):
+        node = SearchNode(cost_add(self.cost, self.choice_cost), self.seq,
+            scope, pair)
+        self.seq += 1
+        heap_push(self.queue, node)
+
+    def resume(self, mach, node):
+        mach.undo(self.mark)
+        self.varmark = self.rootmark
+        pair = node.pair
+        assert isinstance(pair, Compound)
+        self.answer = pair.args[0]
+        self.conj = pair.args[1]
+        self.cost = node.cost
+        self.scope = node.scope
+
+    def invoke(self, goal):
+        if isinstance(goal, Compound) and goal.fsym is TRUE:
+            return
+        self.conj = Compound(AND, [goal, self.conj])
+
+    def expand(self, goals):
+        for goal in reversed(goals):
+            self.invoke(goal)
+
+    def choicepoint(self, mach, goals):
+        conj = self.conj
+        for goal in reversed(goals):
+            conj = Compound(AND, [goal, conj])
+        self.pending.append(mach.variant(Compound(AND, [self.answer, conj])))
+
+    def fail(self):
+        self.conj = failure
+
+    # The choices made in this step are the ones that the commit
+    # takes away, and they wait in the scope.
+    def once(self, goal, then, height, mark):
+        scope = Scope(self.scope, self.pending)
+        self.pending = []
+        self.scope = scope
+        barrier = Barrier(height, mark, None, None, None)
+        barrier.scope = scope
+        self.conj = committed(goal, barrier, then, self.conj)
+
+    def commit(self, mach, barrier):
+        scope = barrier.scope
+        assert isinstance(scope, Scope)
+        queue = []
+        pruned = 0
+        for node in self.queue:
+            if node.scope is not None and node.scope.within(scope):
+                pruned += 1
+            else:
+                queue.append(node)
+        self.queue = []
+        for node in queue:
+            heap_push(self.queue, node)
+        scope.deferred = []
+        self.scope = scope.parent
+        outer = self.scope
+        while outer is not None:
+            outer.live -= pruned
+            outer = outer.parent
+
+    def subgoal(self, conj, disj, cb):
+        return OrderedSearch(conj, disj, cb)
+
+class BreadthFirstSearch(BestFirstSearch):
+    def __init__(self, conj, cb):
+        BestFirstSearch.__init__(self, conj, cb)
+        self.choice_cost = 1
+
+def heap_push(heap, node):
+    heap.append(node)
+    i = len(heap) - 1
+    while i > 0:
+        parent = (i - 1) >> 1
+        if not node.before(heap[parent]):
+            break
+        heap[i] = heap[parent]
+        i = parent
+    heap[i] = node
+
+def heap_pop(heap):
+    top = heap[0]
+    last = heap.pop()
+    if len(heap) > 0:
+        n = len(heap)
+        i = 0
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and heap[child + 1].before(heap[child]):
+                child += 1
+            if not heap[child].before(last):
+                break
+            heap[i] = heap[child]
+            i = child
+        heap[i] = last
+    return top
+
+# The search for a query is chosen by name, with the bounds that
+# iterative deepening starts from.
+SEARCH_ORDERED       = 0
+SEARCH_DEPTH_FIRST   = 1
+SEARCH_DEEPENING     = 2
+SEARCH_BREADTH_FIRST = 3
+SEARCH_BEST_FIRST    = 4
+
+search_modes = {
+    "ordered":       SEARCH_ORDERED,
+    "depth-first":   SEARCH_DEPTH_FIRST,
+    "deepening":     SEARCH_DEEPENING,
+    "breadth-first": SEARCH_BREADTH_FIRST,
+    "best-first":    SEARCH_BEST_FIRST,
+}
+
+class Search(object):
+    _immutable_fields_ = ['mode', 'depth', 'steps']
+    def __init__(self, mode, depth=1, steps=-1):
+        self.mode = mode
+        self.depth = depth
+        self.steps = steps
+
+    def start(self, conj, cb):
+        if self.mode == SEARCH_DEPTH_FIRST:
+            return DepthFirstSearch(conj, [], cb)
+        elif self.mode == SEARCH_DEEPENING:
+            return IterativeDeepening(conj, cb, self.depth, self.steps)
+        elif self.mode == SEARCH_BREADTH_FIRST:
+            return BreadthFirstSearch(conj, cb)
+        elif self.mode == SEARCH_BEST_FIRST:
+            return BestFirstSearch(conj, cb)
+        return OrderedSearch(conj, [], cb)
+
+# A guard that is evaluated inline has no goals of its own. When it
+# binds a variable that goals are waiting on, they end up here, and
+# the guard has to be solved in full after all.
+class InlineGuard(SearchStrategy):
+    def __init__(self, varmark):
+        self.varmark = varmark
+        self.woken = False
+
+    def has_choicepoints(self):
+        return False
+
+    def height(self):
+        return 0
+
+    def describe(self):
+        return ""
+
+    def guard_mark(self):
+        return -1
+
+    def next_goal(self, mach):
+        return None
+
+    def invoke(self, goal):
+        self.woken = True
+
+    def expand(self, goals):
+        self.woken = True
+
+    def choicepoint(self, mach, goals):
+        self.woken = True
+
+    def fail(self):
+        self.woken = True
+
+    def once(self, goal, then, height, mark):
+        self.woken = True
+
+    def commit(self, mach, barrier):
+        self.woken = True
+
+    def subgoal(self, conj, disj, cb):
+        return OrderedSearch(conj, disj, cb)
@@ -1,11 +1,13 @@
 from rply import Token, LexerGenerator, ParserGenerator
 from rply.token import BaseBox
 from objects import Atom, Compound, Variable, known_atoms, atom, as_list
-from objects import parse_integer
+from objects import Integer, parse_integer
+from arithmetic import int_neg
 
 leg = LexerGenerator()
 leg.ignore(r'#.*\n')
 leg.ignore(r'\s+')
+leg.add('IS',           r'is\b(?!\()')
 leg.add('ATOM',         r'[a-z][a-zA-Z0-9_]*')
 leg.add('VARIABLE',     r'[A-Z_][a-zA-Z0-9_]*')
 leg.add('INTEGER',      r'[0-9]+')
@@ -19,7 +21,17 @@ leg.add('AT',           r"@")
 leg.add('VBAR',         r"\|")
 leg.add('SIMP',         r"<=>")
 leg.add('PROP',         r"==>")
+leg.add('ARITHEQ',      r"=:=")
+leg.add('ARITHNE',      r"=\\=")
+leg.add('LE',           r"=<")
+leg.add('GE',           r">=")
+leg.add('LT',           r"<")
+leg.add('GT',           r">")
 leg.add('UNIFY',        r"=")
+leg.add('PLUS',         r"\+")
+leg.add('MINUS',        r"-")
+leg.add('STAR',         r"\*")
+leg.add('SLASH',        r"/")
 leg.add('COLON',        r":")
 leg.add('SEMICOLON',    r";")
 lexer = leg.build()
@@ -30,7 +42,9 @@ pg = ParserGenerator(
      'LEFTBRACKET', 'RIGHTBRACKET', 'COLON',
      'INTEGER',
      'AT', 'VBAR', 'SIMP', 'PROP', 'SEMICOLON',
-     'LEFTPAREN0', 'COMMA', 'LINE'])
+     'LEFTPAREN0', 'COMMA', 'LINE',
+     'IS', 'ARITHEQ', 'ARITHNE', 'LE', 'GE', 'LT', 'GT',
+     'PLUS', 'MINUS', 'MINUS0', 'STAR', 'SLASH'])
 
 @pg.production('file : ')
 def file_blank(env, p):
@@ -88,6 +102,30 @@ def clause_simpagation(env, p):
     return Box(Compound(env.getatom('constraint_rule', 5),
         [name, keep, drop, guard, goal]))
 
+# A declaration names predicates by name and arity:
+#
+#     table path/2, edge/2
+@pg.production('clause : ATOM declaration_list')
+def clause_declaration(env, p):
+    name = p[0].getstr()
+    if name != "table":
+        raise ValueError("Unknown declaration %s" % name)
+    return Box(Compound(env.getatom(name, 1), [unbox(p[1])]))
+
+@pg.production('declaration_list : ATOM SLASH INTEGER')
+def declaration_list_first(env, p):
+    car = Compound(env.getatom('/', 2),
+        [Compound(env.getatom(p[0].getstr(), 0), []),
+         parse_integer(p[2].getstr())])
+    return Box(env.getcons(car, env.getnil()))
+
+@pg.production('declaration_list : ATOM SLASH INTEGER COMMA declaration_list')
+def declaration_list_next(env, p):
+    car = Compound(env.getatom('/', 2),
+        [Compound(env.getatom(p[0].getstr(), 0), []),
+         parse_integer(p[2].getstr())])
+    return Box(env.getcons(car, unbox(p[4])))
+
 @pg.production('guard : ')
 def empty_guard(env, p):
     return Box(Compound(env.getatom('true', 0), []))
@@ -108,11 +146,22 @@ def clause_rule(env, p):
     body = unbox(p[2])
     return Box(Compound(env.getatom('<-', 2), [head, body]))
 
-@pg.production('predicate : predicate20')
+@pg.production('predicate : expression')
+@pg.production('expression : term')
+@pg.production('term : predicate20')
 def predicate_passthrough(env, p):
     return p[0]
 
-@pg.production('predicate : predicate20 COLON predicate')
+@pg.production('expression : expression PLUS term')
+@pg.production('expression : expression MINUS term')
+@pg.production('term : term STAR predicate20')
+def predicate_arithmetic(env, p):
+    left  = unbox(p[0])
+    right = unbox(p[2])
+    atom = env.getatom(p[1].getstr(), 2)
+    return Box(Compound(atom, [left, right]))
+
+@pg.production('predicate : expression COLON predicate')
 def predicate_list(env, p):
     car = unbox(p[0])
     cdr = unbox(p[2])
@@ -139,6 +188,13 @@ def predicate_atom(env, p):
 def predicate_integer(env, p):
     return Box(parse_integer(p[0].getstr()))
 
+@pg.production('predicate20 : MINUS0 predicate20')
+def predicate_negative(env, p):
+    arg = unbox(p[1])
+    if isinstance(arg, Integer):
+        return Box(int_neg(arg))
+    return Box(Compound(env.getatom("-", 1), [arg]))
+
 @pg.production('predicate20 : VARIABLE')
 def predicate_variable(env, p):
     return Box(env.getvar(p[0].getstr()))
@@ -157,6 +213,19 @@ def formula_unify(env, p):
     atom = env.getatom("=", 2)
     return Box(Compound(atom, [left, right]))
 
+@pg.production('formula : predicate IS predicate')
+@pg.production('formula : predicate ARITHEQ predicate')
+@pg.production('formula : predicate ARITHNE predicate')
+@pg.production('formula : predicate LE predicate')
+@pg.production('formula : predicate GE predicate')
+@pg.production('formula : predicate LT predicate')
+@pg.production('formula : predicate GT predicate')
+def formula_arithmetic(env, p):
+    left  = unbox(p[0])
+    right = unbox(p[2])
+    atom = env.getatom(p[1].getstr(), 2)
+    return Box(Compound(atom, [left, right]))
+
 @pg.production('formula   : LEFTPAREN0 predicate RIGHTPAREN')
 @pg.production('predicate20 : LEFTPAREN0 predicate RIGHTPAREN')
 def parentheses(env, p):
@@ -184,6 +253,8 @@ def predicate_list_next(env, p):
 
 @pg.error
 def error_handler(env, token):
+    if token.source_pos is None:
+        raise ValueError("Ran into the end of the input too early")
     raise ValueError("%d: Ran into a %s where it wasn't expected" % 
         (token.source_pos.lineno, token.gettokentype()))
 
@@ -225,6 +296,12 @@ class ParserState(object):
     def getcons(self, car, cdr):
         return Compound(self.getatom(":", 2), [car, cdr])
 
+# A minus sign that cannot continue a term is a prefix minus, and
+# 'is' is an operator only where it can continue a term. Elsewhere,
+# as in write(is) or X = is, it is an ordinary atom. Followed by a
+# parenthesis it is never lexed as IS, so is(X, 3) is a compound.
+ends_term = ["ATOM", "VARIABLE", "INTEGER", "RIGHTPAREN", "RIGHTBRACKET"]
+
 def layout(tokens):
     lineno = -1
     precede = ""
@@ -238,15 +315,50 @@ def layout(tokens):
             precede = ""
         if token.gettokentype() == "LEFTPAREN" and precede != "ATOM":
             yield Token("LEFTPAREN0", token.getstr())
+        elif token.gettokentype() == "MINUS" and precede not in ends_term:
+            yield Token("MINUS0", token.getstr())
+        elif token.gettokentype() == "IS" and precede not in ends_term:
+            yield Token("ATOM", token.getstr(), token.source_pos)
         else:
             yield token
         precede = token.gettokentype()
 
-def parse(source):
-    state = ParserState(0)
+def parse(source, state=None):
+    if state is None:
+        state = ParserState(0)
     code = unbox(parser.parse(layout(lexer.lex(source)), state=state))
     return code, state.next_varno
 
+# A query is read as the body of a clause, in the state the program
+# was parsed in, so that it refers to the same atoms. Returns the
+# goal with the named variables of the query in order of appearance.
+def parse_query(source, state):
+    state.variables = {}
+    code = unbox(parser.parse(layout(lexer.lex("query <- " + source)),
+        state=state))
+    clauses = as_list(code)
+    if len(clauses) != 1:
+        raise ValueError("a query is a single line of goals")
+    clause = clauses[0]
+    assert isinstance(clause, Compound)
+    if clause.fsym is not state.getatom('<-', 2):
+        raise ValueError("a query is a single line of goals")
+    names = []
+    variables = []
+    for name, var in state.variables.iteritems():
+        if name.startswith("_"):
+            continue
+        i = len(variables)
+        names.append(name)
+        variables.append(var)
+        while i > 0 and variables[i-1].varno > var.varno:
+            names[i] = names[i-1]
+            variables[i] = variables[i-1]
+            i -= 1
+        names[i] = name
+        variables[i] = var
+    return clause.args[1], names, variables
+
 class Box(BaseBox):
     def __init__(self, value):
         self.value = value
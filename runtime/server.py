@@ -0,0 +1,148 @@
+from rpython.rlib import rsignal, rsocket
+from rpython.rlib.rarithmetic import string_to_int
+from rpython.rlib.rstring import ParseStringError
+from rply.errors import LexingError
+import machine
+import parser
+import os
+import stat
+
+# The server answers queries against a program that is loaded once.
+# A request is a batch of queries, one per line, ended by an empty
+# line or the end of the input. Every query runs in a Trail of its
+# own, and its solutions are sent back as soon as they are found:
+#
+#     solution: X = 1, Y = a
+#     solution: X = 2, Y = b
+#     done: 2
+#
+# A query without variables has "solution: true". A query that cannot
+# be parsed or run ends with "error" instead of "done", and one that
+# calls exit/1 with "exit: status". An empty line ends the response
+# to the batch. A query that starts with "limit N" stops after N
+# solutions, so that a query with endless solutions gives the server
+# back to the clients after it:
+#
+#     limit 1 member(X, [1, 2])
+def serve(program, state, channel):
+    count = 0
+    while True:
+        line = channel.read_line()
+        if line is None or len(line.strip()) == 0:
+            if count > 0:
+                channel.write("\n")
+                count = 0
+            if line is None:
+                return
+            continue
+        answer(program, state, channel, line)
+        count += 1
+
+def answer(program, state, channel, line):
+    try:
+        limit, query = split_limit(line)
+        goal, names, variables = parser.parse_query(query, state)
+    except LexingError as _:
+        channel.write("error: cannot read the query\n")
+        return
+    except ValueError as _:
+        channel.write("error: cannot read the query\n")
+        return
+    solutions = program.solutions(goal, state.next_varno, limit)
+    try:
+        while solutions.next():
+            channel.write("solution: %s\n" % bindings(names, variables))
+    except machine.Exiting as exit:
+        channel.write("exit: %d\n" % exit.status)
+        return
+    except ValueError as _:
+        channel.write("error: the query failed to run\n")
+        return
+    channel.write("done: %d\n" % solutions.count)
+    solutions.close()
+
+# Returns the limit in front of the query, or -1, and the query.
+def split_limit(line):
+    rest = line.lstrip()
+    if not rest.startswith("limit "):
+        return -1, line
+    rest = rest[len("limit "):].lstrip()
+    i = 0
+    while i < len(rest) and rest[i].isdigit():
+        i += 1
+    try:
+        limit = string_to_int(rest[:i])
+    except ParseStringError as _:
+        raise ValueError("limit takes a number")
+    if limit <= 0:
+        raise ValueError("limit takes a positive number")
+    return limit, rest[i:]
+
+def bindings(names, variables):
+    if len(names) == 0:
+        return "true"
+    out = []
+    for i in range(len(names)):
+        out.append("%s = %s" % (names[i], variables[i].stringify()))
+    return ", ".join(out)
+
+class Channel(object):
+    def __init__(self, infd, outfd):
+        self.infd = infd
+        self.outfd = outfd
+        self.buffer = ""
+        self.eof = False
+
+    # Returns the next line without its newline,
+    # or None at the end of the input.
+    def read_line(self):
+        while True:
+            i = self.buffer.find("\n")
+            if i >= 0:
+                line = self.buffer[:i]
+                self.buffer = self.buffer[i+1:]
+                return line
+            if self.eof:
+                if len(self.buffer) == 0:
+                    return None
+                line = self.buffer
+                self.buffer = ""
+                return line
+            chunk = os.read(self.infd, 4096)
+            if len(chunk) == 0:
+                self.eof = True
+            self.buffer += chunk
+
+    def write(self, data):
+        while len(data) > 0:
+            n = os.write(self.outfd, data)
+            data = data[n:]
+
+def serve_stdio(program, state):
+    serve(program, state, Channel(0, 1))
+
+# Clients connect one after another. A client that goes away
+# in the middle of a response does not stop the server. A socket
+# left at the path by an earlier server is replaced, but any other
+# file stays where it is.
+def serve_socket(program, state, path):
+    rsignal.pypysig_ignore(rsignal.SIGPIPE)
+    try:
+        st = os.lstat(path)
+    except OSError as _:
+        pass
+    else:
+        if not stat.S_ISSOCK(st.st_mode):
+            os.write(2, "not a socket: %s\n" % path)
+            return 1
+        os.unlink(path)
+    sock = rsocket.RSocket(rsocket.AF_UNIX, rsocket.SOCK_STREAM)
+    sock.bind(rsocket.UNIXAddress(path))
+    sock.listen(16)
+    while True:
+        fd, _ = sock.accept()
+        try:
+            serve(program, state, Channel(fd, fd))
+        except OSError as _:
+            pass
+        os.close(fd)